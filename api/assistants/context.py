@@ -0,0 +1,28 @@
+"""Token budgeting of conversation sent for completion"""
+import math
+
+# Tokens every message costs on top of its content
+MESSAGE_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count of text, a token is about 3/4 of a word"""
+    return math.ceil(len(text.split()) * 100 / 75)
+
+
+def message_tokens(message: dict) -> int:
+    """Rough token count of completion message"""
+    return estimate_tokens(message["content"]) + MESSAGE_TOKENS
+
+
+def split_conversation(messages: list[dict], budget: int, min_messages: int) -> int:
+    """Index of the first of the latest messages fitting in budget tokens.
+    min_messages latest messages are kept regardless of budget."""
+    start = len(messages)
+    tokens = 0
+    while start > 0:
+        tokens += message_tokens(messages[start - 1])
+        if tokens > budget and len(messages) - start >= min_messages:
+            break
+        start -= 1
+    return start
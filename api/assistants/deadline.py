@@ -0,0 +1,23 @@
+"""Time budget of a request"""
+import time
+
+
+class Deadline:
+    """Point in time a request should be answered by. Optional stages check
+    remaining time and are skipped, or cut short, when it runs low."""
+
+    def __init__(self, seconds: float):
+        self.expires = time.monotonic() + seconds
+        self.skipped = []
+
+    def remaining(self) -> float:
+        """Seconds left until deadline, negative once it passed"""
+        return self.expires - time.monotonic()
+
+    def allows(self, stage: str, seconds: float) -> bool:
+        """Whether at least seconds are left to run stage,
+        stage is recorded as skipped otherwise"""
+        if self.remaining() >= seconds:
+            return True
+        self.skipped.append(stage)
+        return False
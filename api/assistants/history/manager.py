@@ -1,10 +1,10 @@
 """Creates an interface all assistant can access to interact with the database
 for chat history."""
 
-import openai
-
 from settings import settings
-from api.db.history import history_db, InvalidChatIdException
+from api.upstream.openai_gateway import openai_gateway
+from api.upstream.single_flight import request_key, single_flight
+from api.db.history import async_history_db, InvalidChatIdException
 from api.endpoints.schemas import Chat, Message, MessagesResponse, History
 
 
@@ -14,7 +14,7 @@ class HistoryManager:
     def __init__(self):
         pass
 
-    def process_messages(self, request, response_message, user) -> MessagesResponse:
+    async def process_messages(self, request, response_message, user) -> MessagesResponse:
         """Extract information from request and response, and store in database."""
 
         request.messages.append(response_message)
@@ -23,7 +23,9 @@ class HistoryManager:
         if user:
             # Check if chat id is present
             if request.chat and request.chat.id:
-                return self.update_history(request.chat.id, user.id, request.messages)
+                return await self.update_history(
+                    request.chat.id, user.id, request.messages
+                )
 
             # Otherwise fallback to OpenAI id and user id
             openai_id = None
@@ -36,7 +38,7 @@ class HistoryManager:
                 # and get history id from first ChatGPT response
                 openai_id = request.messages[1].id
 
-            return self.update_history_by_ids(openai_id, user.id, request.messages)
+            return await self.update_history_by_ids(openai_id, user.id, request.messages)
 
         # Otherwise guest user, just messages
         return MessagesResponse(
@@ -44,35 +46,44 @@ class HistoryManager:
             quickReplies=[],
         )
 
-    def get_history(self, chat_id: int, user_id: int) -> History | None:
+    async def get_history(self, chat_id: int, user_id: int) -> History | None:
         """Get history by chat id"""
-        history = history_db.get_history(chat_id)
+        history = await async_history_db.get_history(chat_id)
         if history is None:
             raise InvalidChatIdException
         if history.user_id != user_id:
             raise UnauthorizedUserEditingHistoryException
         return history
 
-    def update_history(self, chat_id: int, user_id: int, messages: list[Message]):
+    async def get_chat(self, chat_id: int, user_id: int) -> Chat:
+        """Get chat by chat id, without its messages"""
+        chat = await async_history_db.get_chat(chat_id)
+        if chat is None:
+            raise InvalidChatIdException
+        owner_id, chat = chat
+        if owner_id != user_id:
+            raise UnauthorizedUserEditingHistoryException
+        return chat
+
+    async def update_history(self, chat_id: int, user_id: int, messages: list[Message]):
         """Update History table by appending new messages for valid chat id"""
-        history = self.get_history(chat_id, user_id)
-        history_db.update_messages(chat_id, messages)
+        chat = await self.get_chat(chat_id, user_id)
+        await async_history_db.update_messages(chat_id, messages)
 
         return MessagesResponse(
-            chat=Chat(id=history.chat.id, summary=history.chat.summary),
+            chat=chat,
             messages=messages,
             quickReplies=[],
         )
 
-    def update_history_by_ids(
+    async def update_history_by_ids(
         self, openai_id: str, user_id: int, messages: list[Message]
     ) -> MessagesResponse:
         """Update History table by appending new messages, otherwise start a
         new conversation."""
-        history = history_db.get_history_by_ids(openai_id, user_id)
+        chat = await async_history_db.get_chat_by_ids(openai_id, user_id)
 
-        chat_id = None
-        if history is None:
+        if chat is None:
             # Prime the conversation with a prompt
             promt = {
                 "role": "system",
@@ -96,30 +107,84 @@ class HistoryManager:
             payload = [promt, first_message]
             # Generate summary
             summary = (
-                openai.ChatCompletion.create(
-                    model=settings.chatgpt_model,
-                    messages=payload,
+                (
+                    await single_flight.do(
+                        request_key("chat", settings.chatgpt_model, payload),
+                        openai_gateway.chat_completion,
+                        model=settings.chatgpt_model,
+                        messages=payload,
+                    )
                 )
                 .choices[0]
                 .message.content
             )
 
-            chat_id = history_db.create_new_history_ids(openai_id, user_id, summary)
-        else:
-            if history.user_id != user_id:
-                raise UnauthorizedUserEditingHistoryException()
-            chat_id = history.chat.id
-
-        history_db.update_messages_by_ids(openai_id, user_id, messages)
+            chat_id = await async_history_db.create_new_history_ids(
+                openai_id, user_id, summary
+            )
+            chat = Chat(id=chat_id, summary=summary)
 
-        history = history_db.get_history(chat_id)
+        await async_history_db.update_messages_by_ids(openai_id, user_id, messages)
 
         return MessagesResponse(
-            chat=Chat(id=chat_id, summary=history.chat.summary),
+            chat=chat,
             messages=messages,
             quickReplies=[],
         )
 
+    async def get_context_summary(
+        self, chat_id: int, user_id: int
+    ) -> tuple[int, str | None]:
+        """Number of leading messages of chat folded into its rolling summary,
+        and the summary"""
+        context = await async_history_db.get_context_summary(chat_id, user_id)
+        return context or (0, None)
+
+    async def fold_messages(
+        self,
+        chat_id: int,
+        user_id: int,
+        summary: str | None,
+        messages: list[dict],
+        summarized_messages: int,
+    ) -> str:
+        """Fold messages into rolling summary of chat, which then covers
+        summarized_messages leading messages, and store it"""
+        conversation = "\n".join(
+            f"{message['role']}: {message['content']}" for message in messages
+        )
+        payload = [
+            {
+                "role": "system",
+                "content": """Summarize conversation of a student with a study
+                assistant in a few sentences. Keep facts the student shared
+                about themselves and questions that were asked.""",
+            },
+            {"role": "user", "content": conversation},
+        ]
+        if summary:
+            payload.insert(
+                1,
+                {
+                    "role": "system",
+                    "content": f"Summary of earlier conversation: {summary}",
+                },
+            )
+        summary = (
+            (
+                await openai_gateway.chat_completion(
+                    model=settings.chatgpt_model,
+                    messages=payload,
+                )
+            )
+            .choices[0]
+            .message.content
+        )
+        await async_history_db.set_context_summary(
+            chat_id, user_id, summarized_messages, summary
+        )
+        return summary
+
 
 class UnauthorizedUserEditingHistoryException(Exception):
     """Raised when user tries to edit history that does not belong to them."""
@@ -0,0 +1,53 @@
+"""Concurrent pipeline of dependent async stages"""
+import asyncio
+import time
+
+
+class Pipeline:
+    """Dependency graph of async stages. A stage starts as soon as stages
+    it depends on are done and receives their results as arguments, so
+    independent stages run concurrently. Duration of every stage is recorded."""
+
+    def __init__(self):
+        # name -> (async function, names of stages it depends on)
+        self.stages = {}
+        self.timings = {}
+
+    def add(self, name: str, function, dependencies: tuple[str, ...] = ()):
+        """Add stage running function once dependencies are done"""
+        for dependency in dependencies:
+            if dependency not in self.stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dependency}")
+        self.stages[name] = (function, dependencies)
+
+    async def run_stage(self, name: str, tasks: dict):
+        """Wait for dependencies and run stage"""
+        function, dependencies = self.stages[name]
+        results = [await tasks[dependency] for dependency in dependencies]
+        start_time = time.perf_counter()
+        try:
+            return await function(*results)
+        finally:
+            self.timings[name] = time.perf_counter() - start_time
+
+    async def run(self) -> dict:
+        """Run all stages, return their results by name.
+        If a stage fails, the rest are cancelled and the error is raised."""
+        tasks = {}
+        for name in self.stages:
+            tasks[name] = asyncio.ensure_future(self.run_stage(name, tasks))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            # Cancelled stages finish before the error is raised
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+        return {name: task.result() for name, task in tasks.items()}
+
+    def server_timing(self) -> str:
+        """Stage durations formatted for Server-Timing header"""
+        return ", ".join(
+            f"{name};dur={duration * 1000:.1f}" for name, duration in self.timings.items()
+        )
@@ -1,5 +1,12 @@
 """Quick Replies assistant functions"""
-import openai
+import asyncio
+
+from settings import settings
+from api.cache.lru import LRUCache
+from api.upstream.openai_gateway import openai_gateway
+
+# Marker of quick replies line in responses generated with inline prompt
+QUICK_REPLIES_MARKER = "QUICK_REPLIES:"
 
 
 def parse_prompt(file: str) -> str:
@@ -9,22 +16,82 @@ def parse_prompt(file: str) -> str:
     return prompt
 
 
-async def generate_quick_replies(message: str) -> list[str]:
-    """Generates quick replies"""
-    prompt = parse_prompt("api/assistants/quick_replies/quick_replies.txt")
+quick_replies_prompt = parse_prompt("api/assistants/quick_replies/quick_replies.txt")
+# Asks assistant to append quick replies to its own response
+inline_quick_replies_prompt = parse_prompt(
+    "api/assistants/quick_replies/inline_quick_replies.txt"
+)
+
+
+def split_quick_replies(content: str) -> tuple[str, list[str]]:
+    """Splits response generated with inline prompt into answer and quick replies"""
+    answer, marker, replies = content.rpartition(QUICK_REPLIES_MARKER)
+    if not marker:
+        return content, []
+    return answer.rstrip(), [
+        reply.strip() for reply in replies.split("//") if reply.strip()
+    ]
+
+
+async def generate_quick_replies(message: str, timeout: float | None = None) -> list[str]:
+    """Generates quick replies, none if they take longer than timeout"""
     # Input gpt response
     messages = [
-        {"role": "system", "content": prompt},
+        {"role": "system", "content": quick_replies_prompt},
         {"role": "assistant", "content": message},
     ]
 
     # Generate open ai response
-    gpt_response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=messages,
-    )
+    try:
+        gpt_response = await openai_gateway.chat_completion(
+            timeout=timeout,
+            model="gpt-3.5-turbo",
+            messages=messages,
+        )
+    except asyncio.TimeoutError:
+        return []
     # Extract response message as string
     response_message = gpt_response["choices"][0].message["content"]
     # Split string into list of sub str and return
     quick_replies = response_message.split("//")
     return quick_replies
+
+
+class DeferredQuickReplies:
+    """Quick replies generated in background, kept by id of the message
+    they are generated for until fetched"""
+
+    def __init__(self, max_entries: int, ttl: float):
+        # message id -> task generating quick replies
+        self.results = LRUCache(max_entries, ttl=ttl)
+        # Running tasks, event loop keeps only weak references to them
+        self.tasks = set()
+
+    async def generate(self, message: str) -> list[str]:
+        """Generate quick replies, none if generation fails"""
+        try:
+            return await generate_quick_replies(message)
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            print(ex)
+            return []
+
+    def start(self, message_id: str, message: str):
+        """Start generating quick replies for message in background"""
+        task = asyncio.ensure_future(self.generate(message))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        self.results.put(message_id, task)
+
+    def get(self, message_id: str) -> list[str] | None:
+        """Quick replies generated for message, None while still generating.
+        Raises KeyError for unknown or expired message id."""
+        task = self.results.get(message_id)
+        if task is None:
+            raise KeyError(message_id)
+        return task.result() if task.done() else None
+
+
+# DeferredQuickReplies singleton
+deferred_quick_replies = DeferredQuickReplies(
+    settings.quick_replies_cache_entries, settings.quick_replies_cache_ttl
+)
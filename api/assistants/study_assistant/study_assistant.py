@@ -1,9 +1,12 @@
 """Study assistant"""
+import asyncio
 import time
 import io
+from uuid import uuid4
 from pydantic import BaseSettings
-import openai
 from settings import settings
+from api.upstream.openai_gateway import openai_gateway
+from api.upstream.single_flight import request_key, single_flight
 from api.endpoints.search import search_engine
 from api.endpoints.user import User
 from api.endpoints.schemas import (
@@ -12,12 +15,24 @@ from api.endpoints.schemas import (
     MessagesRequest,
     MessagesResponse,
 )
+from api.cache.answers import answer_cache
+from api.assistants.context import message_tokens, split_conversation
 from api.assistants.history.manager import HistoryManager
-from api.db.schools import schools_db
+from api.assistants.deadline import Deadline
+from api.assistants.pipeline import Pipeline
+from api.assistants.quick_replies.quick_replies import (
+    QUICK_REPLIES_MARKER,
+    deferred_quick_replies,
+    generate_quick_replies,
+    inline_quick_replies_prompt,
+    split_quick_replies,
+)
+from api.db.history import async_history_db
+from api.db.schools import async_schools_db
 
 history_manager = HistoryManager()
-
-openai.api_key = settings.openai_key
+# Rolling summaries still being generated after the response stopped waiting
+summary_tasks = set()
 
 
 def parse_prompt(file: str) -> str:
@@ -37,6 +52,8 @@ class StudyAssistantSettings(BaseSettings):
 
     temperature: float = 0.8
     max_tokens: int = 400
+    # max_tokens is never cut below this when deadline is close
+    min_tokens: int = 100
 
     prompt: str = prompt
 
@@ -48,22 +65,15 @@ class StudyAssistantSettings(BaseSettings):
 class StudyAssistant(StudyAssistantSettings):
     """Study assistant class"""
 
-    async def generate_response(
-        self,
-        request: MessagesRequest,
-        user: User,
-        school_id: int,
-    ) -> MessagesResponse:
-        """Generates response for answer"""
+    def build_messages(
+        self, conversation: list[dict], user: User, school_name: str, document
+    ) -> list[dict]:
+        """Builds messages for completion"""
         # Places the system prompt at beginning of list
         messages = [{"role": "system", "content": self.prompt}]
         # Appends the rest of the conversation
-        for message in request.messages:
-            messages.append({"role": message.role, "content": message.content})
-        documents = await search_engine.search_text_vectors(request, school_id)
-        document = documents[0] if len(documents) else None
+        messages.extend(conversation)
         if user:
-            school_name = schools_db.get_school_by_id(user.schoolId)
             messages.append(
                 {
                     "role": "system",
@@ -76,20 +86,186 @@ class StudyAssistant(StudyAssistantSettings):
 
         if document:
             messages.append(search_engine.get_system_message(document))
+        return messages
 
-        # Generate response
-        gpt_response = openai.ChatCompletion.create(
-            model=self.model,
-            messages=messages,
-            max_tokens=self.max_tokens,
-            temperature=self.temperature,
+    async def fit_conversation(
+        self, request: MessagesRequest, user: User, budget: int, deadline: Deadline
+    ) -> list[dict]:
+        """Latest messages of conversation fitting in budget tokens. Older ones
+        are replaced by rolling summary of stored chat, or left out for guests."""
+        conversation = [
+            {"role": message.role, "content": message.content}
+            for message in request.messages
+        ]
+        start = split_conversation(conversation, budget, settings.context_min_messages)
+        if start == 0 or not user or not request.chat or not request.chat.id:
+            return conversation[start:]
+
+        summarized, summary = await history_manager.get_context_summary(
+            request.chat.id, user.id
+        )
+        if summarized > len(conversation) - settings.context_min_messages:
+            # Summary of a longer conversation than the one requested
+            summarized, summary = 0, None
+        if summarized < start:
+            # Fold past budget, so that next turns fit without folding again
+            folded = max(
+                start,
+                split_conversation(
+                    conversation, budget // 2, settings.context_min_messages
+                ),
+            )
+            task = asyncio.ensure_future(
+                history_manager.fold_messages(
+                    request.chat.id,
+                    user.id,
+                    summary,
+                    conversation[summarized:folded],
+                    folded,
+                )
+            )
+            summary_tasks.add(task)
+            task.add_done_callback(summary_tasks.discard)
+            try:
+                summary = await asyncio.wait_for(
+                    asyncio.shield(task),
+                    deadline.remaining() - settings.messages_completion_budget,
+                )
+                summarized = folded
+            except asyncio.TimeoutError:
+                # Summary is stored for next turns once it's done
+                deadline.skipped.append("context_summary")
+            except Exception as ex:  # pylint: disable=broad-exception-caught
+                # Messages past the budget are left out rather than failing
+                print(ex)
+        start = max(start, summarized)
+
+        messages = conversation[start:]
+        if summary:
+            messages.insert(
+                0,
+                {
+                    "role": "system",
+                    "content": f"Summary of earlier conversation: {summary}",
+                },
+            )
+        return messages
+
+    def request_deadline(self, request: MessagesRequest) -> Deadline:
+        """Deadline of request, default one unless request sets its own"""
+        return Deadline(request.deadline or settings.messages_deadline)
+
+    def budget_max_tokens(self, deadline: Deadline) -> int:
+        """max_tokens cut proportionally to time left for completion"""
+        remaining = deadline.remaining()
+        if remaining >= settings.messages_completion_budget:
+            return self.max_tokens
+        deadline.skipped.append("full_completion")
+        return max(
+            self.min_tokens,
+            int(self.max_tokens * remaining / settings.messages_completion_budget),
         )
 
+    async def owned_chat_id(self, request: MessagesRequest, user: User) -> int | None:
+        """Id of requested chat if it belongs to user, None otherwise"""
+        if not user or not request.chat or not request.chat.id:
+            return None
+        if await async_history_db.get_chat_owner(request.chat.id) != user.id:
+            return None
+        return request.chat.id
+
+    def add_context_stages(
+        self,
+        pipeline: Pipeline,
+        request: MessagesRequest,
+        user: User,
+        school_id: int,
+        deadline: Deadline,
+    ):
+        """Adds stages looking up user's school and document for conversation,
+        "messages" stage builds messages for completion with them. Query
+        embeddings are requested while gate decides whether to search, gate
+        and search run on other threads. Retrieval is skipped if it would
+        leave completion short of its budget."""
+
+        async def school():
+            return (
+                await async_schools_db.get_school_by_id(user.schoolId) if user else None
+            )
+
+        retrieval = deadline.allows("retrieval", settings.messages_completion_budget)
+
+        async def gate():
+            if not retrieval:
+                return False
+            return await asyncio.to_thread(
+                search_engine.should_search_request, request, school_id
+            )
+
+        async def embeddings():
+            # Requested while gate decides whether they are needed
+            if not retrieval:
+                return []
+            # Embeddings are stored only with chats of their owner
+            chat_id = await self.owned_chat_id(request, user)
+            try:
+                return await asyncio.wait_for(
+                    search_engine.request_embeddings(request, chat_id),
+                    deadline.remaining() - settings.messages_completion_budget,
+                )
+            except asyncio.TimeoutError:
+                deadline.skipped.append("retrieval")
+                return []
+
+        async def search(should_search, query_embeddings):
+            if not should_search or len(query_embeddings) == 0:
+                return None
+            documents = await asyncio.to_thread(
+                search_engine.search_documents, query_embeddings, school_id, k=1
+            )
+            return documents[0] if documents else None
+
+        async def messages(school_name, document):
+            fixed_messages = self.build_messages([], user, school_name, document)
+            budget = settings.context_token_budget - sum(
+                message_tokens(message) for message in fixed_messages
+            )
+            conversation = await self.fit_conversation(request, user, budget, deadline)
+            return self.build_messages(conversation, user, school_name, document)
+
+        pipeline.add("school", school)
+        pipeline.add("gate", gate)
+        pipeline.add("embeddings", embeddings)
+        pipeline.add("search", search, ("gate", "embeddings"))
+        pipeline.add("messages", messages, ("school", "search"))
+
+    def inline_quick_replies(self, messages: list[dict]) -> list[dict]:
+        """Messages asking for quick replies within the response"""
+        return messages + [{"role": "system", "content": inline_quick_replies_prompt}]
+
+    async def prepare_messages(
+        self,
+        request: MessagesRequest,
+        user: User,
+        school_id: int,
+        pipeline: Pipeline = None,
+        deadline: Deadline = None,
+    ):
+        """Builds messages for completion along with the document found for them"""
+        pipeline = Pipeline() if pipeline is None else pipeline
+        deadline = self.request_deadline(request) if deadline is None else deadline
+        self.add_context_stages(pipeline, request, user, school_id, deadline)
+        results = await pipeline.run()
+        return results["messages"], results["search"]
+
+    def get_attachments(
+        self, content: str, document, school_id: int
+    ) -> list[MessageAttachment]:
+        """Attach document to response if its content is close to the document"""
         attachments = []
-        # Attach document to user message content
         if document:
             include_doc = search_engine.should_search_docs(
-                gpt_response["choices"][0]["message"]["content"],
+                content,
                 0.5,
                 school_id,
                 [document.document],
@@ -109,17 +285,237 @@ class StudyAssistant(StudyAssistantSettings):
                         image=image_src,
                     )
                 )
+        return attachments
 
-        # Convert to Message schema
-        response_message = Message(
-            id=gpt_response["id"],
-            role=gpt_response["choices"][0]["message"]["role"],
-            timestamp=time.time(),
-            content=gpt_response["choices"][0]["message"]["content"],
-            attachments=attachments,
+    async def answer_cache_key(self, request: MessagesRequest, school_id: int):
+        """Answer cache key of single-turn request, None for conversations"""
+        if not settings.answer_cache or len(request.messages) != 1:
+            return None
+        embeddings = await search_engine.generate_embeddings_batch(
+            [request.messages[0].content]
         )
+        return (school_id, search_engine.school_fingerprint(school_id), embeddings[0])
+
+    async def cached_response(
+        self, request: MessagesRequest, user: User, cache_key, quick_replies: bool
+    ) -> MessagesResponse | None:
+        """Generates response reusing answer cached for similar question,
+        None if there is no such answer"""
+        cached = answer_cache.get(*cache_key)
+        if cached is None:
+            return None
+        message, replies = cached
+        # Chats are looked up by id of their first response, so it must not repeat
+        response_message = message.copy(
+            update={"id": f"cache-{uuid4()}", "timestamp": time.time()}, deep=True
+        )
+        response = await history_manager.process_messages(request, response_message, user)
+        if not quick_replies or response_message.attachments:
+            return response
+        if settings.quick_replies_mode != "deferred":
+            response.quickReplies = replies
+            return response
+        deferred_quick_replies.start(response_message.id, response_message.content)
+        response.quickRepliesTicket = response_message.id
+        return response
+
+    async def generate_response(
+        self,
+        request: MessagesRequest,
+        user: User,
+        school_id: int,
+        quick_replies: bool = False,
+        pipeline: Pipeline = None,
+        deadline: Deadline = None,
+    ) -> MessagesResponse:
+        """Generates response for answer, with quick replies if asked to.
+        Independent stages run concurrently, timings are kept in pipeline.
+        Optional stages are skipped as deadline comes close."""
+        pipeline = Pipeline() if pipeline is None else pipeline
+        deadline = self.request_deadline(request) if deadline is None else deadline
+        # Single-turn questions are answered from cache when possible
+        cache_key = await self.answer_cache_key(request, school_id)
+        if cache_key is not None:
+            response = await self.cached_response(request, user, cache_key, quick_replies)
+            if response is not None:
+                return response
+
+        self.add_context_stages(pipeline, request, user, school_id, deadline)
+        inline = quick_replies and settings.quick_replies_mode == "inline"
+
+        async def completion(messages):
+            max_tokens = self.budget_max_tokens(deadline)
+            # Quick replies line could be cut off from a shortened completion
+            inline_replies = inline and max_tokens == self.max_tokens
+            if inline_replies:
+                messages = self.inline_quick_replies(messages)
+            gpt_response, joined = await single_flight.do_joined(
+                request_key("chat", self.model, messages, max_tokens, self.temperature),
+                openai_gateway.chat_completion,
+                model=self.model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=self.temperature,
+            )
+            content = gpt_response["choices"][0]["message"]["content"]
+            # None unless quick replies are within the response
+            suggested = None
+            if inline_replies:
+                content, suggested = split_quick_replies(content)
+            # Convert to Message schema, callers sharing a completion get
+            # ids of their own as chats are looked up by response id
+            response_message = Message(
+                id=f"{gpt_response['id']}-{uuid4().hex}"
+                if joined
+                else gpt_response["id"],
+                role=gpt_response["choices"][0]["message"]["role"],
+                timestamp=time.time(),
+                content=content,
+            )
+            return response_message, suggested
 
-        return history_manager.process_messages(request, response_message, user)
+        async def attachments(completion_result, document):
+            response_message, _ = completion_result
+            if deadline.allows("attachments", 0):
+                response_message.attachments = self.get_attachments(
+                    response_message.content, document, school_id
+                )
+            return response_message
+
+        async def history(response_message):
+            return await history_manager.process_messages(request, response_message, user)
+
+        async def replies(response_message, completion_result):
+            # Generate list of quick replies
+            # only if no attachments added
+            if not quick_replies or len(response_message.attachments) > 0:
+                return []
+            if completion_result[1] is not None:
+                return completion_result[1]
+            if inline or settings.quick_replies_mode == "deferred":
+                # None stands for quick replies fetched later by message id,
+                # inline ones fall back to them when completion was shortened
+                deferred_quick_replies.start(
+                    response_message.id, response_message.content
+                )
+                return None
+            if not deadline.allows(
+                "quick_replies", settings.messages_quick_replies_budget
+            ):
+                return []
+            return await generate_quick_replies(
+                response_message.content, deadline.remaining()
+            )
+
+        pipeline.add("completion", completion, ("messages",))
+        pipeline.add("attachments", attachments, ("completion", "search"))
+        pipeline.add("history", history, ("attachments",))
+        pipeline.add("quick_replies", replies, ("attachments", "completion"))
+        results = await pipeline.run()
+
+        response = results["history"]
+        if results["quick_replies"] is None:
+            response.quickRepliesTicket = results["attachments"].id
+        else:
+            response.quickReplies = results["quick_replies"]
+        # Answers cut short by deadline are not reused
+        if (
+            cache_key is not None
+            and quick_replies
+            and set(deadline.skipped) <= {"quick_replies"}
+        ):
+            answer_cache.put(*cache_key, (results["attachments"], response.quickReplies))
+        return response
+
+    async def stream_completion(
+        self, messages: list[dict], max_tokens: int, inline: bool
+    ):
+        """Streams completion as "token" events followed by "message" event
+        with the complete message and quick replies it contains. In inline mode
+        the tail that may start quick replies line is held back from tokens."""
+        response_id = None
+        role = "assistant"
+        content = []
+        # Length of content sent as tokens
+        sent = 0
+        async for chunk in openai_gateway.chat_completion_stream(
+            model=self.model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=self.temperature,
+        ):
+            response_id = chunk["id"]
+            delta = chunk["choices"][0]["delta"]
+            role = delta.get("role", role)
+            if delta.get("content"):
+                content.append(delta["content"])
+                if not inline:
+                    yield "token", {"content": delta["content"]}
+                    continue
+                text = "".join(content)
+                end = text.find(QUICK_REPLIES_MARKER)
+                end = len(text) - len(QUICK_REPLIES_MARKER) if end < 0 else end
+                # Whitespace may precede quick replies line
+                end = len(text[:end].rstrip())
+                if end > sent:
+                    yield "token", {"content": text[sent:end]}
+                    sent = end
+
+        content = "".join(content)
+        suggested = []
+        if inline:
+            content, suggested = split_quick_replies(content)
+            if len(content) > sent:
+                yield "token", {"content": content[sent:]}
+
+        message = Message(
+            id=response_id, role=role, timestamp=time.time(), content=content
+        )
+        yield "message", (message, suggested)
+
+    async def generate_response_stream(
+        self,
+        request: MessagesRequest,
+        user: User,
+        school_id: int,
+        deadline: Deadline = None,
+        quick_replies: bool = False,
+    ):
+        """Generates response for answer as (event, data) pairs: "token" for
+        every piece of content as it arrives, then "attachments" and "chat"
+        once the response is complete and stored in history.
+        In inline quick replies mode "quickReplies" follows if asked for."""
+        deadline = self.request_deadline(request) if deadline is None else deadline
+        messages, document = await self.prepare_messages(
+            request, user, school_id, deadline=deadline
+        )
+        max_tokens = self.budget_max_tokens(deadline)
+        # Quick replies line could be cut off from a shortened completion,
+        # they are generated separately then if there's time left
+        inline = (
+            quick_replies
+            and settings.quick_replies_mode == "inline"
+            and max_tokens == self.max_tokens
+        )
+        if inline:
+            messages = self.inline_quick_replies(messages)
+
+        async for event, data in self.stream_completion(messages, max_tokens, inline):
+            if event == "token":
+                yield event, data
+            else:
+                response_message, suggested = data
+
+        if deadline.allows("attachments", 0):
+            response_message.attachments = self.get_attachments(
+                response_message.content, document, school_id
+            )
+        yield "attachments", response_message.attachments
+
+        response = await history_manager.process_messages(request, response_message, user)
+        yield "chat", {"chat": response.chat, "message": response_message}
+        if inline:
+            yield "quickReplies", [] if response_message.attachments else suggested
 
     async def generate_response_audio(
         self, audio_file, chat_id: int | None, user: User | None, school_id: int
@@ -128,10 +524,12 @@ class StudyAssistant(StudyAssistantSettings):
 
         # Convert audio file to byte stream, due to unknown reasons
         # OpenAI does not accept SpooledTemporaryFile's
-        buffer = io.BytesIO(audio_file.file.read())
+        buffer = io.BytesIO(await audio_file.read())
         buffer.name = audio_file.filename
         # Transcribe audio byte stream to text
-        transcript = openai.Audio.transcribe("whisper-1", buffer, response_format="text")
+        transcript = await openai_gateway.transcribe(
+            "whisper-1", buffer, response_format="text"
+        )
 
         # Start new conversation if no chat_id is present
         if chat_id is None:
@@ -149,7 +547,7 @@ class StudyAssistant(StudyAssistantSettings):
 
         # Otherwise append transcription to existing chat history
         # Attempt to get chat history
-        chat_history = history_manager.get_history(chat_id, user.id)
+        chat_history = await history_manager.get_history(chat_id, user.id)
 
         request = MessagesRequest(
             chat=chat_history.chat,
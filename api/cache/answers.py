@@ -0,0 +1,75 @@
+"""Semantic cache of answers to single-turn questions"""
+import threading
+import uuid
+
+import numpy as np
+
+from settings import settings
+from api.cache.lru import LRUCache
+from se_indexing.db_engine.matrix import normalize_rows
+
+
+class AnswerCache:
+    """Answers keyed by school and question embedding. An answer is reused
+    for questions of the same school similar enough to the one it was given
+    for, as long as documents of the school were not reindexed since."""
+
+    def __init__(self, max_entries: int | None, ttl: float | None, threshold: float):
+        # key -> (school id, school index fingerprint, question embedding, answer)
+        self.answers = LRUCache(max_entries, ttl=ttl)
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, school_id: int | None, fingerprint: str, embedding):
+        """Answer to the most similar question above threshold, None if missing"""
+        embedding = normalize_rows(np.atleast_2d(np.asarray(embedding, dtype=np.float32)))
+        keys = []
+        embeddings = []
+        for key, (school, entry_fingerprint, question, _) in self.answers.items():
+            if school != school_id:
+                continue
+            if entry_fingerprint != fingerprint:
+                # Documents of the school were reindexed
+                self.answers.pop(key)
+                continue
+            keys.append(key)
+            embeddings.append(question)
+
+        entry = None
+        if embeddings:
+            similarities = np.vstack(embeddings) @ embedding[0]
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                entry = self.answers.get(keys[best])
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return entry[3]
+
+    def put(self, school_id: int | None, fingerprint: str, embedding, answer):
+        """Store answer to question with given embedding"""
+        embedding = normalize_rows(np.atleast_2d(np.asarray(embedding, dtype=np.float32)))
+        self.answers.put(uuid.uuid4().hex, (school_id, fingerprint, embedding[0], answer))
+
+    def stats(self) -> dict:
+        """Cache usage statistics"""
+        stats = self.answers.stats()
+        lookups = self.hits + self.misses
+        stats.update(
+            hits=self.hits,
+            misses=self.misses,
+            hit_ratio=self.hits / lookups if lookups else 0.0,
+        )
+        return stats
+
+
+# AnswerCache singleton
+answer_cache = AnswerCache(
+    settings.answer_cache_entries,
+    settings.answer_cache_ttl,
+    settings.answer_cache_threshold,
+)
@@ -0,0 +1,175 @@
+"""Cache of text embeddings, in-process with an optional SQLite tier"""
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+import numpy as np
+
+from settings import settings
+from api.cache.lru import LRUCache
+from api.db.connection import get_connection_manager
+
+# Keys looked up in SQLite by a single query
+query_batch_size = 500
+
+
+def normalize_text(text: str) -> str:
+    """Case and whitespace insensitive form of text used in cache keys"""
+    return " ".join(text.split()).casefold()
+
+
+def embedding_key(model: str, text: str) -> str:
+    """Cache key of text embedded with model"""
+    return hashlib.sha256(f"{model}\n{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Embeddings keyed by model and normalized text. Least recently used
+    embeddings are kept in memory, up to disk_entries most recent ones are
+    kept in SQLite if path is set. SQLite is read and written on threads,
+    never on the event loop."""
+
+    def __init__(
+        self,
+        max_entries: int | None,
+        max_bytes: int | None,
+        ttl: float | None = None,
+        path: str | None = None,
+        disk_entries: int | None = None,
+        prune_interval: int = 1000,
+    ):
+        self.memory = LRUCache(
+            max_entries, max_bytes, ttl, sizeof=lambda embedding: embedding.nbytes
+        )
+        self.ttl = ttl
+        self.disk_entries = disk_entries
+        self.prune_interval = prune_interval
+        # Writes to SQLite since it was last pruned
+        self.writes = 0
+        self.disk_hits = 0
+        self.database = None
+        self.lock = threading.Lock()
+        if path:
+            self.database = get_connection_manager(path)
+            self.create_if_not_exists()
+            self.prune()
+
+    def create_if_not_exists(self):
+        """Create embedding_cache table if it doesn't exist."""
+        with self.database.transaction() as connection:
+            connection.execute(
+                """CREATE TABLE IF NOT EXISTS embedding_cache (
+                        key TEXT PRIMARY KEY,
+                        created REAL NOT NULL,
+                        embedding BLOB NOT NULL
+                )"""
+            )
+            connection.execute(
+                """CREATE INDEX IF NOT EXISTS embedding_cache_created
+                ON embedding_cache (created)"""
+            )
+
+    def prune(self):
+        """Remove expired embeddings from SQLite, and the oldest ones
+        past disk_entries"""
+        with self.lock:
+            self.writes = 0
+        with self.database.transaction() as connection:
+            if self.ttl is not None:
+                connection.execute(
+                    "DELETE FROM embedding_cache WHERE created < ?",
+                    (time.time() - self.ttl,),
+                )
+            if self.disk_entries is not None:
+                connection.execute(
+                    """DELETE FROM embedding_cache WHERE key IN (
+                        SELECT key FROM embedding_cache
+                        ORDER BY created DESC LIMIT -1 OFFSET ?
+                    )""",
+                    (self.disk_entries,),
+                )
+
+    def read(self, keys: list[str]) -> dict[str, np.ndarray]:
+        """Unexpired embeddings stored in SQLite for keys, by key"""
+        embeddings = {}
+        with closing(self.database.connection().cursor()) as cursor:
+            for start in range(0, len(keys), query_batch_size):
+                batch = keys[start : start + query_batch_size]
+                cursor.execute(
+                    f"""SELECT key, created, embedding FROM embedding_cache
+                    WHERE key IN ({", ".join("?" * len(batch))})""",
+                    batch,
+                )
+                for key, created, embedding in cursor.fetchall():
+                    if self.ttl is None or created + self.ttl >= time.time():
+                        embeddings[key] = np.frombuffer(embedding, dtype=np.float32)
+        return embeddings
+
+    def write(self, embeddings: dict[str, np.ndarray]):
+        """Store embeddings in SQLite by key in a single transaction,
+        pruning it every prune_interval writes"""
+        created = time.time()
+        with self.database.transaction() as connection:
+            connection.executemany(
+                """INSERT OR REPLACE INTO embedding_cache (key, created, embedding)
+                VALUES (?, ?, ?)""",
+                [
+                    (key, created, sqlite3.Binary(embedding.tobytes()))
+                    for key, embedding in embeddings.items()
+                ],
+            )
+        with self.lock:
+            self.writes += len(embeddings)
+            prune = self.writes >= self.prune_interval
+        if prune:
+            self.prune()
+
+    async def get_many(self, model: str, texts: list[str]) -> list[np.ndarray | None]:
+        """Cached embeddings of texts, None for missing or expired ones"""
+        keys = [embedding_key(model, text) for text in texts]
+        embeddings = [self.memory.get(key) for key in keys]
+        missing = [key for key, embedding in zip(keys, embeddings) if embedding is None]
+        if not missing or self.database is None:
+            return embeddings
+
+        stored = await asyncio.to_thread(self.read, missing)
+        for index, key in enumerate(keys):
+            if embeddings[index] is None and key in stored:
+                embeddings[index] = stored[key]
+                self.memory.put(key, stored[key])
+                self.disk_hits += 1
+        return embeddings
+
+    async def put_many(self, model: str, texts: list[str], embeddings):
+        """Store embeddings of texts"""
+        stored = {}
+        for text, embedding in zip(texts, embeddings):
+            key = embedding_key(model, text)
+            stored[key] = np.asarray(embedding, dtype=np.float32)
+            self.memory.put(key, stored[key])
+        if stored and self.database is not None:
+            await asyncio.to_thread(self.write, stored)
+
+    def stats(self) -> dict:
+        """Cache usage statistics, hit ratio counts SQLite hits too"""
+        stats = self.memory.stats()
+        lookups = stats["hits"] + stats["misses"]
+        stats["disk_hits"] = self.disk_hits
+        stats["hit_ratio"] = (
+            (stats["hits"] + self.disk_hits) / lookups if lookups else 0.0
+        )
+        return stats
+
+
+# EmbeddingCache singleton
+embedding_cache = EmbeddingCache(
+    settings.embedding_cache_entries,
+    settings.embedding_cache_bytes,
+    settings.embedding_cache_ttl,
+    settings.embedding_cache_path,
+    settings.embedding_cache_disk_entries,
+    settings.embedding_cache_prune_interval,
+)
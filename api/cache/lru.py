@@ -0,0 +1,103 @@
+"""In-process least recently used cache"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Least recently used cache bounded by entry count and total size of values.
+    Entries expire ttl seconds after being stored if ttl is set."""
+
+    def __init__(
+        self,
+        max_entries: int | None = None,
+        max_bytes: int | None = None,
+        ttl: float | None = None,
+        sizeof=sys.getsizeof,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        # key -> (expiry time, size, value), least recently used first
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """Return value stored for key and mark it as recently used"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, value):
+        """Store value for key, evicting least recently used entries if needed"""
+        size = self.sizeof(value)
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (expires, size, value)
+            self.bytes += size
+            while self.entries and (
+                (self.max_entries is not None and len(self.entries) > self.max_entries)
+                or (self.max_bytes is not None and self.bytes > self.max_bytes)
+            ):
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        """Remove key and return its value"""
+        with self.lock:
+            if key not in self.entries:
+                return default
+            return self._remove(key)
+
+    def items(self) -> list:
+        """Unexpired (key, value) pairs, least recently used first.
+        Doesn't mark them as used."""
+        now = time.monotonic()
+        with self.lock:
+            return [
+                (key, value)
+                for key, (expires, _, value) in self.entries.items()
+                if expires is None or expires >= now
+            ]
+
+    def clear(self):
+        """Remove all entries"""
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def _remove(self, key):
+        _, size, value = self.entries.pop(key)
+        self.bytes -= size
+        return value
+
+    def stats(self) -> dict:
+        """Cache usage statistics"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
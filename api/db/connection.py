@@ -0,0 +1,104 @@
+"""Connections to API database shared by its stores"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from settings import settings
+
+
+class ConnectionManager:
+    """Connections to SQLite database, one per thread so that threads never
+    share a connection. The database is kept in WAL mode, readers then run
+    concurrently with a writer and writers wait for each other up to
+    busy_timeout instead of failing with "database is locked"."""
+
+    def __init__(
+        self,
+        path: str,
+        busy_timeout: float,
+        synchronous: str,
+        mmap_size: int,
+    ):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.pragmas = (
+            f"PRAGMA busy_timeout = {int(busy_timeout * 1000)};",
+            "PRAGMA journal_mode = WAL;",
+            f"PRAGMA synchronous = {synchronous};",
+            f"PRAGMA mmap_size = {mmap_size};",
+        )
+        self.local = threading.local()
+        # Connections of all threads, closed together
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        """New connection with pragmas applied"""
+        # Only the thread opening it uses the connection, but close()
+        # may be called from another one
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        for pragma in self.pragmas:
+            connection.execute(pragma)
+        with self.lock:
+            self.connections.append(connection)
+        return connection
+
+    def connection(self) -> sqlite3.Connection:
+        """Connection of current thread, opened on first use"""
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = self.connect()
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        """Write transaction on connection of current thread, committed on
+        exit and rolled back on error. The write lock is taken up front so
+        the transaction never fails halfway on a concurrent writer, keep it
+        short as writers wait for each other. Nested transactions join the
+        outer one."""
+        connection = self.connection()
+        if connection.in_transaction:
+            yield connection
+            return
+        connection.execute("BEGIN IMMEDIATE;")
+        try:
+            yield connection
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+
+    def close(self):
+        """Close connections of all threads"""
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.close()
+        self.local = threading.local()
+
+
+# Connection managers by database path
+connection_managers = {}
+connection_managers_lock = threading.Lock()
+
+
+def get_connection_manager(path: str) -> ConnectionManager:
+    """Connection manager of database at path, shared by stores using it"""
+    with connection_managers_lock:
+        if path not in connection_managers:
+            connection_managers[path] = ConnectionManager(
+                path,
+                settings.db_busy_timeout,
+                settings.db_synchronous,
+                settings.db_mmap_size,
+            )
+        return connection_managers[path]
+
+
+def close_connections():
+    """Close connections to all databases"""
+    with connection_managers_lock:
+        for manager in connection_managers.values():
+            manager.close()
@@ -0,0 +1,78 @@
+"""Async access to API database stores"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from settings import settings
+
+
+class DatabaseExecutor:
+    """Runs blocking store calls on threads instead of the event loop.
+    Reads run on a bounded pool of reader threads, writes on a single
+    writer thread, so writes of a worker never wait for each other's locks.
+    Every thread keeps its own connection to the database."""
+
+    def __init__(self, reader_threads: int):
+        self.reader_threads = reader_threads
+        self.readers = None
+        self.writer = None
+        self.start()
+
+    def start(self):
+        """Start threads, unless they are running already. Calls made after
+        shutdown start them again."""
+        if self.readers is None:
+            self.readers = ThreadPoolExecutor(
+                self.reader_threads, thread_name_prefix="db-reader"
+            )
+            self.writer = ThreadPoolExecutor(1, thread_name_prefix="db-writer")
+
+    async def run(self, executor: ThreadPoolExecutor, function, *args, **kwargs):
+        """Result of function called on a thread of executor"""
+        return await asyncio.get_running_loop().run_in_executor(
+            executor, functools.partial(function, *args, **kwargs)
+        )
+
+    async def read(self, function, *args, **kwargs):
+        """Result of function called on a reader thread"""
+        self.start()
+        return await self.run(self.readers, function, *args, **kwargs)
+
+    async def write(self, function, *args, **kwargs):
+        """Result of function called on the writer thread"""
+        self.start()
+        return await self.run(self.writer, function, *args, **kwargs)
+
+    def shutdown(self):
+        """Wait for running calls and stop threads, pending calls are cancelled.
+        Threads are started again by start()."""
+        if self.readers is None:
+            return
+        readers, writer = self.readers, self.writer
+        self.readers = self.writer = None
+        readers.shutdown(cancel_futures=True)
+        writer.shutdown(cancel_futures=True)
+
+
+class AsyncStore:
+    """Async facade of a store. Its methods are awaited instead of called,
+    and run on the writer thread if listed in writes, on a reader thread
+    otherwise."""
+
+    def __init__(self, store, writes: set[str]):
+        self.store = store
+        self.writes = writes
+
+    def __getattr__(self, name: str):
+        method = getattr(self.store, name)
+        run = database_executor.write if name in self.writes else database_executor.read
+
+        @functools.wraps(method)
+        async def call(*args, **kwargs):
+            return await run(method, *args, **kwargs)
+
+        return call
+
+
+# DatabaseExecutor singleton
+database_executor = DatabaseExecutor(settings.db_reader_threads)
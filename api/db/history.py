@@ -1,13 +1,86 @@
 """history.py implement HistoryDB that handles all database interactions."""
 
-import os
 import sqlite3
 import pickle
+import time
 import zlib
 from contextlib import closing
 
+import numpy as np
+
 from settings import settings
-from api.endpoints.schemas import Message, History, Chat
+from api.db.migrations import (
+    Migration,
+    add_column,
+    forget_migrations,
+    migrate,
+)
+from api.db.connection import get_connection_manager
+from api.db.executor import AsyncStore
+from api.endpoints.schemas import Message, History, Chat, ChatSummary
+
+# Schema versions of History tables, in order
+history_migrations = [
+    Migration(
+        "create chat tables",
+        (
+            """
+            CREATE TABLE IF NOT EXISTS chat_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                openai_id TEXT,
+                user_id INTEGER REFERENCES auth_users(id),
+                summary TEXT,
+                messages BLOB
+            );""",
+            """
+            CREATE TABLE IF NOT EXISTS chat_embeddings (
+                chat_id INTEGER REFERENCES chat_history(id),
+                key TEXT,
+                embedding BLOB,
+                PRIMARY KEY (chat_id, key)
+            );""",
+            """
+            CREATE TABLE IF NOT EXISTS chat_context (
+                chat_id INTEGER PRIMARY KEY REFERENCES chat_history(id),
+                summarized_messages INTEGER,
+                summary TEXT
+            );""",
+        ),
+    ),
+    Migration(
+        "store messages one row per message",
+        (
+            """
+            CREATE TABLE IF NOT EXISTS chat_messages (
+                chat_id INTEGER REFERENCES chat_history(id),
+                position INTEGER,
+                message TEXT,
+                PRIMARY KEY (chat_id, position)
+            );""",
+        ),
+    ),
+    Migration(
+        "track chat activity",
+        (
+            add_column("chat_history", "updated_at", "REAL"),
+            "UPDATE chat_history SET updated_at = 0 WHERE updated_at IS NULL;",
+            # Replaced by covering index of the next version
+            "DROP INDEX IF EXISTS chat_history_user_updated;",
+        ),
+    ),
+    Migration(
+        "index chat lookups",
+        (
+            # Covers listing of user's chats by activity
+            """
+            CREATE INDEX IF NOT EXISTS chat_history_user_activity
+            ON chat_history (user_id, updated_at DESC, id DESC, summary);""",
+            """
+            CREATE INDEX IF NOT EXISTS chat_history_openai_user
+            ON chat_history (openai_id, user_id);""",
+        ),
+    ),
+]
 
 
 class HistoryDB:
@@ -16,11 +89,9 @@ class HistoryDB:
     db_path = "data/db/history.db"
 
     def __init__(self, db_path):
-        os.makedirs(os.path.dirname(db_path), exist_ok=True)
         self.db_path = db_path
+        self.database = get_connection_manager(db_path)
         try:
-            self.connection = sqlite3.connect(self.db_path)
-
             self.create_if_not_exists()
         except sqlite3.Error as error:
             print("Failed to connect to HistoryDB.")
@@ -28,36 +99,31 @@ class HistoryDB:
             print(error.sqlite_errorcode)
             print(error.sqlite_errorname)
 
-    def __del__(self):
-        if self.connection:
-            self.connection = self.connection.close()
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """Connection of current thread"""
+        return self.database.connection()
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if self.connection:
-            self.connection = self.connection.close()
+        self.database.close()
 
     def create_if_not_exists(self):
-        """Create History table if it doesn't exist."""
-        sql_create_history_table = """
-        CREATE TABLE IF NOT EXISTS chat_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            openai_id TEXT,
-            user_id INTEGER REFERENCES auth_users(id),
-            summary TEXT,
-            messages BLOB
-        );"""
-        with closing(self.connection.cursor()) as cursor:
-            cursor.execute(sql_create_history_table)
-        self.connection.commit()
+        """Create History tables if they don't exist, and bring them
+        to the latest schema version."""
+        migrate(self.connection, "history", history_migrations)
 
     def delete(self):
-        """Delete History table."""
+        """Delete History tables."""
         with closing(self.connection.cursor()) as cursor:
+            cursor.execute("DROP TABLE IF EXISTS chat_embeddings")
+            cursor.execute("DROP TABLE IF EXISTS chat_context")
+            cursor.execute("DROP TABLE IF EXISTS chat_messages")
             cursor.execute("DROP TABLE IF EXISTS chat_history")
         self.connection.commit()
+        forget_migrations(self.connection, "history")
 
     def get_history(self, chat_id: int) -> History | None:
         """Grab singular history by id and return it."""
@@ -78,7 +144,7 @@ class HistoryDB:
                 return History(
                     user_id=history_raw[2],
                     chat=Chat(id=history_raw[0], summary=history_raw[3]),
-                    messages=uncompress_messages(history_raw[4]),
+                    messages=self.read_messages(cursor, history_raw[0], history_raw[4]),
                 )
         except sqlite3.Error as error:
             print(f"Failed query: {sql_select_history}\n{error}")
@@ -107,26 +173,84 @@ class HistoryDB:
                 return History(
                     user_id=history_raw[2],
                     chat=Chat(id=history_raw[0], summary=history_raw[3]),
-                    messages=uncompress_messages(history_raw[4]),
+                    messages=self.read_messages(cursor, history_raw[0], history_raw[4]),
                 )
         except sqlite3.Error as error:
             print(f"Failed query: {sql_select_history}\n{error}")
             raise HistoryDbException from error
 
+    def get_chat(self, chat_id: int) -> tuple[int, Chat] | None:
+        """Return owner's user id and chat with matching id, without messages."""
+        sql_query = """
+        SELECT id, user_id, summary FROM chat_history WHERE id = ?;"""
+        try:
+            with closing(self.connection.cursor()) as cursor:
+                cursor.execute(sql_query, (chat_id,))
+                row = cursor.fetchone()
+                if row is None:
+                    return None
+                return row[1], Chat(id=row[0], summary=row[2])
+        except sqlite3.Error as error:
+            print(f"Failed query: {sql_query}\n{error}")
+            raise HistoryDbException from error
+
+    def get_chat_owner(self, chat_id: int) -> int | None:
+        """Return user id of chat owner, None if chat is not found."""
+        sql_query = """
+        SELECT user_id FROM chat_history WHERE id = ?;"""
+        try:
+            with closing(self.connection.cursor()) as cursor:
+                cursor.execute(sql_query, (chat_id,))
+                row = cursor.fetchone()
+                return None if row is None else row[0]
+        except sqlite3.Error as error:
+            print(f"Failed query: {sql_query}\n{error}")
+            raise HistoryDbException from error
+
+    def get_chat_by_ids(self, openai_id: str, user_id: int) -> Chat | None:
+        """Return chat with matching ids, without messages."""
+        sql_query = """
+        SELECT id, summary FROM chat_history WHERE openai_id = ? AND user_id = ?;"""
+        try:
+            with closing(self.connection.cursor()) as cursor:
+                cursor.execute(sql_query, (openai_id, user_id))
+                row = cursor.fetchone()
+                if row is None:
+                    return None
+                return Chat(id=row[0], summary=row[1])
+        except sqlite3.Error as error:
+            print(f"Failed query: {sql_query}\n{error}")
+            raise HistoryDbException from error
+
     def get_all_history_by_user_id(self, user_id: int) -> list[History] | None:
         """Grab all history for user and return"""
         sql_select_all_history = """
         SELECT * FROM chat_history WHERE user_id = ?;"""
 
+        sql_select_all_messages = """
+        SELECT chat_id, message FROM chat_messages
+        WHERE chat_id IN (SELECT id FROM chat_history WHERE user_id = ?)
+        ORDER BY chat_id, position;"""
+
         # Grab all chat_history for user
         history_raw = None
         with closing(self.connection.cursor()) as cursor:
             cursor.execute(sql_select_all_history, (user_id,))
             history_raw = cursor.fetchall()
 
-        # Check if SELECT failed to find user_id
-        if history_raw is None:
-            raise InvalidUserIdException
+            # Check if SELECT failed to find user_id
+            if history_raw is None:
+                raise InvalidUserIdException
+
+            messages = {}
+            cursor.execute(sql_select_all_messages, (user_id,))
+            for chat_id, message in cursor.fetchall():
+                messages.setdefault(chat_id, []).append(Message.parse_raw(message))
+
+        # Chats still stored as blobs are read from them
+        for row in history_raw:
+            if row[4] is not None:
+                messages[row[0]] = uncompress_messages(row[4])
 
         # Convert raw data to History objects
         history: list[History] = []
@@ -135,20 +259,49 @@ class HistoryDB:
                 History(
                     user_id=row[2],
                     chat=Chat(id=row[0], summary=row[3]),
-                    messages=uncompress_messages(row[4]),
+                    messages=messages.get(row[0], []),
                 )
             )
 
         # Return History
         return history
 
+    def get_chat_summaries(
+        self,
+        user_id: int,
+        limit: int,
+        after: tuple[float, int] | None = None,
+    ) -> list[ChatSummary]:
+        """Return up to limit chats of user without their messages, most
+        recently active first, starting after (updated_at, id) of a chat."""
+        sql_query = """
+        SELECT id, summary, updated_at FROM chat_history WHERE user_id = ?
+        ORDER BY updated_at DESC, id DESC LIMIT ?;"""
+        parameters = (user_id, limit)
+        if after is not None:
+            sql_query = """
+            SELECT id, summary, updated_at FROM chat_history
+            WHERE user_id = ? AND (updated_at < ? OR (updated_at = ? AND id < ?))
+            ORDER BY updated_at DESC, id DESC LIMIT ?;"""
+            parameters = (user_id, after[0], after[0], after[1], limit)
+        try:
+            with closing(self.connection.cursor()) as cursor:
+                cursor.execute(sql_query, parameters)
+                return [
+                    ChatSummary(id=chat_id, summary=summary, updatedAt=updated_at)
+                    for chat_id, summary, updated_at in cursor.fetchall()
+                ]
+        except sqlite3.Error as error:
+            print(f"Failed query: {sql_query}\n{error}")
+            raise HistoryDbException from error
+
     def create_new_history_ids(
         self, openai_id: str, user_id: int, summary: str | None
     ) -> int:
         """Create new history and return id."""
         sql_query = """
-        INSERT INTO chat_history (openai_id, user_id, summary, messages)
-        VALUES (?, ?, ?, NULL);"""
+        INSERT INTO chat_history (openai_id, user_id, summary, messages, updated_at)
+        VALUES (?, ?, ?, NULL, ?);"""
         with closing(self.connection.cursor()) as cursor:
             cursor.execute(
                 sql_query,
@@ -156,92 +309,111 @@ class HistoryDB:
                     openai_id,
                     user_id,
                     summary,
+                    time.time(),
                 ),
             )
             self.connection.commit()
             return cursor.lastrowid
 
+    def read_messages(self, cursor, chat_id: int, blob) -> list[Message]:
+        """Return messages of chat. Messages still stored as blob are read
+        from it, they are moved to chat_messages by writes and
+        migrate_message_blobs, never by reads."""
+        if blob is not None:
+            return uncompress_messages(blob)
+        cursor.execute(
+            "SELECT message FROM chat_messages WHERE chat_id = ? ORDER BY position;",
+            (chat_id,),
+        )
+        return [Message.parse_raw(row[0]) for row in cursor.fetchall()]
+
+    def move_messages(self, cursor, chat_id: int) -> bool:
+        """Move messages blob of chat to chat_messages, one row per message.
+        The blob is read within the transaction, chats moved meanwhile by
+        another worker are skipped. Return whether the chat was moved."""
+        with self.database.transaction():
+            cursor.execute("SELECT messages FROM chat_history WHERE id = ?;", (chat_id,))
+            row = cursor.fetchone()
+            if row is None or row[0] is None:
+                return False
+            cursor.execute("DELETE FROM chat_messages WHERE chat_id = ?;", (chat_id,))
+            self.insert_messages(cursor, chat_id, 0, uncompress_messages(row[0]))
+            cursor.execute(
+                "UPDATE chat_history SET messages = NULL WHERE id = ?;", (chat_id,)
+            )
+        return True
+
+    def insert_messages(self, cursor, chat_id: int, position: int, messages):
+        """Insert messages of chat starting at position."""
+        cursor.executemany(
+            """
+            INSERT OR REPLACE INTO chat_messages (chat_id, position, message)
+            VALUES (?, ?, ?);""",
+            [
+                (chat_id, position + offset, message.json())
+                for offset, message in enumerate(messages)
+            ],
+        )
+
     def get_messages(self, chat_id: int) -> list[Message]:
-        """Return json data from column messages in History table."""
+        """Return messages of chat."""
         sql_query = """
         SELECT messages FROM chat_history WHERE id = ?;"""
 
-        # Get messages blob from history
-        message_blob = None
         with closing(self.connection.cursor()) as cursor:
-            cursor.execute(
-                sql_query,
-                (chat_id,),
-            )
-            message_blob = cursor.fetchone()
-
-        # Check if SELECT failed to find by history_id
-        if message_blob is None:
-            raise InvalidChatIdException
-
-        # We only want the first element
-        message_blob = message_blob[0]
+            cursor.execute(sql_query, (chat_id,))
+            row = cursor.fetchone()
 
-        messages = []
-        # Check if blob contains any data (could be newly created History)
-        if message_blob:
-            # Uncompress and unpickle the blob
-            messages = uncompress_messages(message_blob)
+            # Check if SELECT failed to find by history_id
+            if row is None:
+                raise InvalidChatIdException
 
-        return messages
+            return self.read_messages(cursor, chat_id, row[0])
 
     def get_messages_by_ids(self, openai_id: str, user_id: int) -> list[Message]:
-        """Return json data from column messages in History table."""
+        """Return messages of chat with matching ids."""
         sql_query = """
-        SELECT messages FROM chat_history WHERE openai_id = ? AND user_id = ?;"""
+        SELECT id, messages FROM chat_history WHERE openai_id = ? AND user_id = ?;"""
 
-        # Get messages blob from history
-        message_blob = None
         with closing(self.connection.cursor()) as cursor:
-            cursor.execute(
-                sql_query,
-                (
-                    openai_id,
-                    user_id,
-                ),
-            )
-            message_blob = cursor.fetchone()
+            cursor.execute(sql_query, (openai_id, user_id))
+            row = cursor.fetchone()
 
-        # Check if SELECT failed to find by history_id
-        if message_blob is None:
-            raise InvalidHistoryException
+            # Check if SELECT failed to find by history_id
+            if row is None:
+                raise InvalidHistoryException
 
-        # We only want the first element
-        message_blob = message_blob[0]
+            return self.read_messages(cursor, row[0], row[1])
 
-        messages = []
-        # Check if blob contains any data (could be newly created History)
-        if message_blob:
-            # Uncompress and unpickle the blob
-            messages = uncompress_messages(message_blob)
+    def append_messages(self, cursor, chat_id: int, messages: list[Message]):
+        """Store messages of chat, only those past the stored ones are written.
+        Stored messages past the given ones are removed."""
+        with self.database.transaction():
+            cursor.execute("SELECT id FROM chat_history WHERE id = ?;", (chat_id,))
+            if cursor.fetchone() is None:
+                raise InvalidChatIdException
+            self.move_messages(cursor, chat_id)
 
-        return messages
+            cursor.execute(
+                "SELECT COUNT(*) FROM chat_messages WHERE chat_id = ?;", (chat_id,)
+            )
+            stored = cursor.fetchone()[0]
+            if len(messages) < stored:
+                cursor.execute(
+                    "DELETE FROM chat_messages WHERE chat_id = ? AND position >= ?;",
+                    (chat_id, len(messages)),
+                )
+            self.insert_messages(cursor, chat_id, stored, messages[stored:])
+            cursor.execute(
+                "UPDATE chat_history SET updated_at = ? WHERE id = ?;",
+                (time.time(), chat_id),
+            )
 
     def update_messages(self, chat_id: int, messages: list[Message]):
-        """Update messages column for row with matching id"""
+        """Store new messages of chat with matching id"""
         try:
-            sql_query = """
-            UPDATE chat_history SET messages = ? WHERE id = ?;"""
-
-            # Compress and pickle messages
-            blob = compress_messages(messages)
-
-            # Update database
             with closing(self.connection.cursor()) as cursor:
-                cursor.execute(
-                    sql_query,
-                    (
-                        sqlite3.Binary(blob),
-                        chat_id,
-                    ),
-                )
-
-            self.connection.commit()
+                self.append_messages(cursor, chat_id, messages)
         except sqlite3.Error as error:
             print(f"Error while updating history messages with id = {chat_id}: {error}")
             raise InvalidChatIdException from error
@@ -249,33 +421,121 @@ class HistoryDB:
     def update_messages_by_ids(
         self, openai_id: str, user_id: int, messages: list[Message]
     ):
-        """Update messages column for row with matching ids"""
+        """Store new messages of chat with matching ids"""
+        sql_query = """
+        SELECT id FROM chat_history WHERE openai_id = ? AND user_id = ?;"""
         try:
-            sql_query = """
-            UPDATE chat_history SET messages = ? WHERE openai_id = ? AND user_id = ?;"""
+            with closing(self.connection.cursor()) as cursor:
+                cursor.execute(sql_query, (openai_id, user_id))
+                row = cursor.fetchone()
+                if row is None:
+                    raise InvalidHistoryException
+                self.append_messages(cursor, row[0], messages)
+        except sqlite3.Error as error:
+            print(f"Error while updating history messages with id = {openai_id}: {error}")
+            raise InvalidHistoryException from error
 
-            # Compress and pickle messages
-            blob = compress_messages(messages)
+    def migrate_message_blobs(self, limit: int) -> int:
+        """Move messages of up to limit chats still stored as blobs
+        to chat_messages, return number of chats found. Chats moved meanwhile
+        by another worker are counted as well, 0 means none is left."""
+        sql_query = """
+        SELECT id FROM chat_history WHERE messages IS NOT NULL LIMIT ?;"""
+        with closing(self.connection.cursor()) as cursor:
+            cursor.execute(sql_query, (limit,))
+            chat_ids = [row[0] for row in cursor.fetchall()]
+            for chat_id in chat_ids:
+                self.move_messages(cursor, chat_id)
+        return len(chat_ids)
+
+    def get_embeddings(self, chat_id: int) -> dict[str, np.ndarray]:
+        """Return message embeddings stored for chat, by embedding key."""
+        sql_query = """
+        SELECT key, embedding FROM chat_embeddings WHERE chat_id = ?;"""
+        try:
+            with closing(self.connection.cursor()) as cursor:
+                cursor.execute(sql_query, (chat_id,))
+                return {
+                    key: np.frombuffer(embedding, dtype=np.float32)
+                    for key, embedding in cursor.fetchall()
+                }
+        except sqlite3.Error as error:
+            print(f"Failed query: {sql_query}\n{error}")
+            raise HistoryDbException from error
 
-            # Update database
+    def add_embeddings(self, chat_id: int, embeddings: dict[str, np.ndarray]):
+        """Store message embeddings for chat, by embedding key."""
+        sql_query = """
+        INSERT OR REPLACE INTO chat_embeddings (chat_id, key, embedding)
+        VALUES (?, ?, ?);"""
+        try:
             with closing(self.connection.cursor()) as cursor:
-                cursor.execute(
+                cursor.executemany(
                     sql_query,
-                    (
-                        sqlite3.Binary(blob),
-                        openai_id,
-                        user_id,
-                    ),
+                    [
+                        (
+                            chat_id,
+                            key,
+                            sqlite3.Binary(
+                                np.asarray(embedding, dtype=np.float32).tobytes()
+                            ),
+                        )
+                        for key, embedding in embeddings.items()
+                    ],
                 )
+            self.connection.commit()
+        except sqlite3.Error as error:
+            print(f"Failed query: {sql_query}\n{error}")
+            raise HistoryDbException from error
+
+    def get_context_summary(self, chat_id: int, user_id: int) -> tuple[int, str] | None:
+        """Return number of leading messages of user's chat folded into its
+        rolling summary, and the summary."""
+        sql_query = """
+        SELECT summarized_messages, chat_context.summary FROM chat_context
+        JOIN chat_history ON chat_history.id = chat_context.chat_id
+        WHERE chat_id = ? AND user_id = ?;"""
+        try:
+            with closing(self.connection.cursor()) as cursor:
+                cursor.execute(sql_query, (chat_id, user_id))
+                return cursor.fetchone()
+        except sqlite3.Error as error:
+            print(f"Failed query: {sql_query}\n{error}")
+            raise HistoryDbException from error
 
+    def set_context_summary(
+        self, chat_id: int, user_id: int, summarized_messages: int, summary: str
+    ):
+        """Store rolling summary of leading messages of user's chat."""
+        sql_query = """
+        INSERT OR REPLACE INTO chat_context (chat_id, summarized_messages, summary)
+        SELECT id, ?, ? FROM chat_history WHERE id = ? AND user_id = ?;"""
+        try:
+            with closing(self.connection.cursor()) as cursor:
+                cursor.execute(
+                    sql_query, (summarized_messages, summary, chat_id, user_id)
+                )
             self.connection.commit()
         except sqlite3.Error as error:
-            print(f"Error while updating history messages with id = {openai_id}: {error}")
-            raise InvalidHistoryException from error
+            print(f"Failed query: {sql_query}\n{error}")
+            raise HistoryDbException from error
 
 
 # HistoryDB singleton
 history_db = HistoryDB(settings.db_path)
+# Async HistoryDB facade singleton
+async_history_db = AsyncStore(
+    history_db,
+    writes={
+        "delete",
+        "create_new_history_ids",
+        "update_messages",
+        "update_messages_by_ids",
+        "migrate_message_blobs",
+        "add_embeddings",
+        "set_context_summary",
+    },
+)
 
 
 class InvalidUserIdException(Exception):
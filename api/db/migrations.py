@@ -0,0 +1,78 @@
+"""Versioned schema migrations for SQLite databases"""
+import time
+from contextlib import closing
+from typing import NamedTuple
+
+SQL_CREATE_MIGRATIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    store TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    applied_at REAL NOT NULL,
+    PRIMARY KEY (store, version)
+);"""
+
+
+class Migration(NamedTuple):
+    """Schema change made of SQL statements or functions taking a cursor"""
+
+    name: str
+    statements: tuple
+
+
+def add_column(table: str, column: str, definition: str):
+    """Migration statement adding column to table unless it's there already"""
+
+    def statement(cursor):
+        cursor.execute(f"PRAGMA table_info({table});")
+        if column not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition};")
+
+    return statement
+
+
+def migrate(connection, store: str, migrations: list[Migration]):
+    """Apply migrations of store missing from database, in order.
+    Migration i is version i + 1 of store schema, applied versions are
+    recorded in schema_migrations table. Every migration is applied in its
+    own transaction, so concurrent processes apply it only once."""
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(SQL_CREATE_MIGRATIONS_TABLE)
+        connection.commit()
+        cursor.execute("SELECT version FROM schema_migrations WHERE store = ?", (store,))
+        applied = {row[0] for row in cursor.fetchall()}
+
+        for version, migration in enumerate(migrations, 1):
+            if version in applied:
+                continue
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                # Another process may have applied it meanwhile
+                cursor.execute(
+                    "SELECT 1 FROM schema_migrations WHERE store = ? AND version = ?",
+                    (store, version),
+                )
+                if cursor.fetchone() is None:
+                    for statement in migration.statements:
+                        if callable(statement):
+                            statement(cursor)
+                        else:
+                            cursor.execute(statement)
+                    cursor.execute(
+                        """INSERT INTO schema_migrations
+                        (store, version, name, applied_at) VALUES (?, ?, ?, ?)""",
+                        (store, version, migration.name, time.time()),
+                    )
+                    print(f"Applied {store} schema version {version}: {migration.name}")
+                connection.commit()
+            except BaseException:
+                connection.rollback()
+                raise
+
+
+def forget_migrations(connection, store: str):
+    """Remove records of migrations applied for store, once its tables are dropped"""
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(SQL_CREATE_MIGRATIONS_TABLE)
+        cursor.execute("DELETE FROM schema_migrations WHERE store = ?", (store,))
+    connection.commit()
@@ -1,11 +1,29 @@
 """
     schools database
 """
-import os
 import sqlite3
 from contextlib import closing
 
 from settings import settings
+from api.db.migrations import Migration, migrate
+from api.db.connection import get_connection_manager
+from api.db.executor import AsyncStore
+
+
+# Schema versions of schools table, in order
+schools_migrations = [
+    Migration(
+        "create schools table",
+        (
+            """CREATE TABLE IF NOT EXISTS schools (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    title VARCHAR NOT NULL,
+                    short_name VARCHAR NOT NULL,
+                    url VARCHAR NOT NULL
+            )""",
+        ),
+    ),
+]
 
 
 class SchoolsDB:
@@ -14,31 +32,26 @@ class SchoolsDB:
     db_path = "data/db/schools.db"
 
     def __init__(self, db_path):
-        os.makedirs(os.path.dirname(db_path), exist_ok=True)
         self.db_path = db_path
+        self.database = get_connection_manager(db_path)
         try:
-            self.connection = sqlite3.connect(self.db_path)
-
             self.create_database_if_not_exists()
         except sqlite3.Error as error:
             print(f"Failed to establish connection to database\n{error}")
 
-    def __del__(self):
-        self.connection.commit()
-        self.connection.close()
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """Connection of current thread"""
+        return self.database.connection()
 
     def create_database_if_not_exists(self):
-        """Creates schools table if needed"""
+        """Creates schools table if needed and seeds it"""
+        migrate(self.connection, "schools", schools_migrations)
 
-        with closing(self.connection.cursor()) as cursor:
-            cursor.execute(
-                """CREATE TABLE IF NOT EXISTS schools (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        title VARCHAR NOT NULL,
-                        short_name VARCHAR NOT NULL,
-                        url VARCHAR NOT NULL
-                )"""
-            )
+        # Workers starting together seed the table once
+        with self.database.transaction() as connection, closing(
+            connection.cursor()
+        ) as cursor:
             (rows,) = cursor.execute("SELECT COUNT(id) from schools").fetchone()
             if rows == 0:
                 cursor.executemany(
@@ -78,3 +91,5 @@ class SchoolsDB:
 
 
 schools_db = SchoolsDB(settings.db_path)
+# Async SchoolsDB facade singleton
+async_schools_db = AsyncStore(schools_db, writes=set())
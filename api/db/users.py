@@ -2,7 +2,6 @@
     Users database 
 """
 import hashlib
-import os
 import sqlite3
 import uuid
 from contextlib import closing
@@ -10,6 +9,9 @@ from contextlib import closing
 from pydantic import BaseModel
 
 from settings import settings
+from api.db.migrations import Migration, migrate
+from api.db.connection import get_connection_manager
+from api.db.executor import AsyncStore
 
 
 def get_pass_hash(password: str, salt: str):
@@ -39,47 +41,56 @@ class AuthEntry(BaseModel):
         )
 
 
+# Schema versions of auth_* tables, in order
+users_migrations = [
+    Migration(
+        "create auth tables",
+        (
+            """CREATE TABLE IF NOT EXISTS auth_users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    email VARCHAR NOT NULL,
+                    school_id INTEGER NOT NULL REFERENCES schools(id),
+                    password_hash BLOB NOT NULL,
+                    salt BLOB NOT NULL
+            )""",
+            """CREATE TABLE IF NOT EXISTS auth_tokens (
+                    user_id INTEGER PRIMARY KEY,
+                    token TEXT,
+                    FOREIGN KEY (user_id) REFERENCES auth_users(id)
+            )""",
+        ),
+    ),
+    Migration(
+        "index users by email",
+        (
+            """CREATE INDEX IF NOT EXISTS auth_users_email
+            ON auth_users (email)""",
+        ),
+    ),
+]
+
+
 class UsersDB:
     """users.db wrapper"""
 
     db_path = "data/db/users.db"
 
     def __init__(self, db_path):
-        os.makedirs(os.path.dirname(db_path), exist_ok=True)
         self.db_path = db_path
+        self.database = get_connection_manager(db_path)
         try:
-            self.connection = sqlite3.connect(self.db_path)
-
             self.create_database_if_not_exists()
         except sqlite3.Error as ex:
             print(f"Failed to establish connection to database\n{ex}")
 
-    def __del__(self):
-        self.connection.commit()
-        self.connection.close()
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """Connection of current thread"""
+        return self.database.connection()
 
     def create_database_if_not_exists(self):
-        """Creates auth_* tables if needed"""
-        with closing(self.connection.cursor()) as cursor:
-            cursor.execute(
-                """CREATE TABLE IF NOT EXISTS auth_users (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        email VARCHAR NOT NULL,
-                        school_id INTEGER NOT NULL REFERENCES schools(id),
-                        password_hash BLOB NOT NULL,
-                        salt BLOB NOT NULL
-                )"""
-            )
-
-            cursor.execute(
-                """CREATE TABLE IF NOT EXISTS auth_tokens (
-                        user_id INTEGER PRIMARY KEY,
-                        token TEXT,
-                        FOREIGN KEY (user_id) REFERENCES auth_users(id)
-                )"""
-            )
-
-        self.connection.commit()
+        """Creates auth_* tables if needed and brings them to the latest schema version"""
+        migrate(self.connection, "users", users_migrations)
 
     # TODO: Use user id instead of email for most of the cases except register.
     # As auth_users and auth_tokens contain the same user id, we should be
@@ -162,3 +173,7 @@ class UsersDB:
 
 
 users_db = UsersDB(settings.db_path)
+# Async UsersDB facade singleton
+async_users_db = AsyncStore(
+    users_db, writes={"add_token", "add_user", "change_school_id"}
+)
@@ -0,0 +1,106 @@
+"""Admission control for endpoints calling OpenAI"""
+import asyncio
+import time
+
+from fastapi import HTTPException
+
+from settings import settings
+
+
+class AdmissionController:
+    """Limits requests handled at once. Requests over the limit wait in a
+    bounded queue, they are rejected with 429 once the queue is full and
+    with 503 if no slot frees up within queue_timeout seconds."""
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        max_queue: int,
+        queue_timeout: float,
+        retry_after: int,
+    ):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.running = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def reject(self, status_code: int, detail: str) -> HTTPException:
+        """Rejection asking client to retry later"""
+        return HTTPException(
+            status_code=status_code,
+            detail=detail,
+            headers={"Retry-After": str(self.retry_after)},
+        )
+
+    async def wait(self):
+        """Wait in queue for a slot"""
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise self.reject(429, "Too many requests.")
+
+        self.waiting += 1
+        start_time = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError as ex:
+            self.timed_out += 1
+            raise self.reject(503, "Service busy.") from ex
+        finally:
+            self.waiting -= 1
+            wait_time = time.perf_counter() - start_time
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    async def __call__(self):
+        """FastAPI dependency holding a slot while request is handled"""
+        if not self.semaphore.locked():
+            # Free slot is taken without suspending
+            await self.semaphore.acquire()
+        else:
+            await self.wait()
+
+        self.admitted += 1
+        self.running += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self.semaphore.release()
+
+    def stats(self) -> dict:
+        """Queue depth and wait time statistics"""
+        waited = self.admitted + self.timed_out
+        return {
+            "running": self.running,
+            "queue_depth": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "mean_wait_time": self.wait_time / waited if waited else 0.0,
+            "max_wait_time": self.max_wait_time,
+        }
+
+
+def create_admission_controller() -> AdmissionController:
+    """Admission controller configured by settings"""
+    return AdmissionController(
+        settings.admission_max_concurrency,
+        settings.admission_max_queue,
+        settings.admission_queue_timeout,
+        settings.admission_retry_after,
+    )
+
+
+# Admission controllers by OpenAI endpoint the requests they admit call
+admission = {
+    "chat": create_admission_controller(),
+    "audio": create_admission_controller(),
+    "embeddings": create_admission_controller(),
+}
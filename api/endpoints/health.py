@@ -1,6 +1,11 @@
 """Service health check endpoints"""
 from fastapi import APIRouter
 
+from api.cache.answers import answer_cache
+from api.endpoints.admission import admission
+from api.cache.embeddings import embedding_cache
+from api.upstream.single_flight import single_flight
+
 health_router = APIRouter(prefix="/health", tags=[""])
 
 
@@ -10,3 +15,14 @@ async def health() -> dict:
     return {
         "ok": True,
     }
+
+
+@health_router.get("/metrics")
+async def metrics() -> dict:
+    """Cache and upstream call statistics of the API worker"""
+    return {
+        "embedding_cache": embedding_cache.stats(),
+        "answer_cache": answer_cache.stats(),
+        "single_flight": single_flight.stats(),
+        "admission": {name: controller.stats() for name, controller in admission.items()},
+    }
@@ -1,14 +1,21 @@
 """
     History endpoint
 """
+import base64
+import binascii
 from typing import Annotated
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from pydantic import Field
 from fastapi_pagination import Page, paginate
 
-from api.endpoints.schemas import HistoryResponse, History
+from api.endpoints.schemas import (
+    ChatSummariesResponse,
+    ChatSummary,
+    HistoryResponse,
+    History,
+)
 from api.endpoints.user import get_current_user
-from api.db.history import history_db, HistoryDbException, InvalidUserIdException
+from api.db.history import async_history_db, HistoryDbException, InvalidUserIdException
 
 history_router = APIRouter(prefix="/history", tags=[""])
 
@@ -19,7 +26,7 @@ async def get_history_from_user_id(
 ) -> HistoryResponse:
     """Returns a list of user's history"""
     try:
-        history = history_db.get_all_history_by_user_id(user.id)
+        history = await async_history_db.get_all_history_by_user_id(user.id)
         return HistoryResponse(history=history)
     except InvalidUserIdException as error:
         raise HTTPException(status_code=404, detail="User not found") from error
@@ -39,10 +46,61 @@ async def get_history_from_user_id_paged(
 ) -> Page[History]:
     """Returns a paginated list of user's history"""
     try:
-        history = history_db.get_all_history_by_user_id(user.id)
+        history = await async_history_db.get_all_history_by_user_id(user.id)
         return paginate(history)
     except InvalidUserIdException as error:
         raise HTTPException(status_code=404, detail="User not found") from error
     except HistoryDbException as error:
         # Server DB error
         raise HTTPException(status_code=500) from error
+
+
+def encode_cursor(chat: ChatSummary) -> str:
+    """Opaque cursor of listing position right after chat"""
+    return base64.urlsafe_b64encode(f"{chat.updatedAt!r}:{chat.id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[float, int]:
+    """(updated_at, id) of chat encoded in cursor"""
+    try:
+        updated_at, chat_id = base64.urlsafe_b64decode(cursor.encode()).split(b":")
+        return float(updated_at), int(chat_id)
+    except (binascii.Error, ValueError) as error:
+        raise HTTPException(status_code=400, detail="Invalid cursor") from error
+
+
+@history_router.get("/chats")
+async def get_chats(
+    user: Annotated[str, Depends(get_current_user)],
+    cursor: str | None = None,
+    limit: int = Query(20, ge=1, le=500),
+) -> ChatSummariesResponse:
+    """Returns a page of user's chats without their messages, most recently
+    active first. Next page is requested with nextCursor of previous one."""
+    try:
+        chats = await async_history_db.get_chat_summaries(
+            user.id, limit, decode_cursor(cursor) if cursor else None
+        )
+    except HistoryDbException as error:
+        # Server DB error
+        raise HTTPException(status_code=500) from error
+    return ChatSummariesResponse(
+        chats=chats,
+        nextCursor=encode_cursor(chats[-1]) if len(chats) == limit else None,
+    )
+
+
+@history_router.get("/chats/{chat_id}")
+async def get_chat(
+    chat_id: int,
+    user: Annotated[str, Depends(get_current_user)],
+) -> History:
+    """Returns user's chat with its messages"""
+    try:
+        history = await async_history_db.get_history(chat_id)
+    except HistoryDbException as error:
+        # Server DB error
+        raise HTTPException(status_code=500) from error
+    if history is None or history.user_id != user.id:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    return history
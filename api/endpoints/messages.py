@@ -1,28 +1,44 @@
 """Messages endpoint"""
 
+import json
 import time
 
-from fastapi import APIRouter, Depends, Form, HTTPException, UploadFile
+from fastapi import APIRouter, Depends, Form, HTTPException, Response, UploadFile
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from typing_extensions import Annotated
 
-from api.endpoints.schemas import MessagesRequest, MessagesResponse
+from api.endpoints.schemas import (
+    MessagesRequest,
+    MessagesResponse,
+    QuickRepliesResponse,
+)
 from api.assistants.study_assistant.study_assistant import (
     StudyAssistant,
     UsersMessageMissingException,
 )
 from api.assistants.history.manager import UnauthorizedUserEditingHistoryException
-from api.assistants.quick_replies.quick_replies import generate_quick_replies
+from api.assistants.pipeline import Pipeline
+from api.assistants.quick_replies.quick_replies import (
+    deferred_quick_replies,
+    generate_quick_replies,
+)
 from api.db.history import InvalidHistoryException, InvalidChatIdException
+from api.endpoints.admission import admission
 from api.endpoints.user import get_current_user_optional
+from settings import settings
 
 assistant = StudyAssistant()
 messages_router = APIRouter(prefix="/messages", tags=[""])
 
 
-@messages_router.post("/", response_model_exclude_none=True)
+@messages_router.post(
+    "/", response_model_exclude_none=True, dependencies=[Depends(admission["chat"])]
+)
 async def messages(
     request: MessagesRequest,
     user: Annotated[str, Depends(get_current_user_optional)],
+    response: Response,
 ) -> MessagesResponse:
     """Takes list of messages or audio file and returns response from assistant."""
     start_time = time.time()
@@ -35,30 +51,29 @@ async def messages(
         school_id = user.schoolId if user and user.schoolId else None
 
         # Pass request to assistant, assuming last message is user's
-        assistant_response = await assistant.generate_response(request, user, school_id)
-        resp_message = assistant_response.messages[-1]
-        assistant_message = resp_message.content
-        main_time = time.time()
-        # Generate list of quick replies
-        # only if no attachments added
-        quick_replies = (
-            await generate_quick_replies(assistant_message)
-            if len(resp_message.attachments) == 0 and main_time - start_time < 2.5
-            else []
+        pipeline = Pipeline()
+        deadline = assistant.request_deadline(request)
+        assistant_response = await assistant.generate_response(
+            request,
+            user,
+            school_id,
+            quick_replies=True,
+            pipeline=pipeline,
+            deadline=deadline,
         )
 
         end_time = time.time()
+        stage_timings = "\n".join(
+            f"{name:>17}: {duration:.2f}s" for name, duration in pipeline.timings.items()
+        )
         print(
             f"""messages request time elapsed
              full: {end_time - start_time:.2f}s
-             base: {main_time - start_time:.2f}s
-    quick replies: {end_time - main_time:.2f}s"""
-        )
-        return MessagesResponse(
-            chat=assistant_response.chat,
-            messages=assistant_response.messages,
-            quickReplies=quick_replies,
+{stage_timings}
+          skipped: {", ".join(deadline.skipped) or "none"}"""
         )
+        response.headers["Server-Timing"] = pipeline.server_timing()
+        return assistant_response
     except UsersMessageMissingException as ex:
         raise HTTPException(
             status_code=400, detail=str("User's message missing.")
@@ -79,7 +94,100 @@ async def messages(
         raise HTTPException(status_code=500, detail=str("Internal server error")) from ex
 
 
-@messages_router.post("/audio", response_model_exclude_none=True)
+@messages_router.get("/quick-replies/{message_id}")
+async def messages_quick_replies(message_id: str) -> QuickRepliesResponse:
+    """Returns quick replies deferred for assistant message with message_id."""
+    try:
+        replies = deferred_quick_replies.get(message_id)
+    except KeyError as ex:
+        raise HTTPException(
+            status_code=404, detail=str("Quick replies not found.")
+        ) from ex
+    if replies is None:
+        return QuickRepliesResponse(status="pending")
+    return QuickRepliesResponse(status="ready", quickReplies=replies)
+
+
+def server_sent_event(event: str, data) -> str:
+    """Formats event for text/event-stream response"""
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(data))}\n\n"
+
+
+async def stream_events(request: MessagesRequest, user, school_id: int | None):
+    """Streams assistant response followed by quick replies as server-sent events"""
+    start_time = time.time()
+    deadline = assistant.request_deadline(request)
+    try:
+        quick_replies = None
+        async for event, data in assistant.generate_response_stream(
+            request, user, school_id, deadline, quick_replies=True
+        ):
+            if event == "chat":
+                resp_message = data["message"]
+            if event == "quickReplies":
+                quick_replies = data
+            yield server_sent_event(event, data)
+
+        if quick_replies is None:
+            # Generate list of quick replies
+            # only if no attachments added
+            quick_replies = (
+                await generate_quick_replies(resp_message.content, deadline.remaining())
+                if len(resp_message.attachments) == 0
+                and deadline.allows(
+                    "quick_replies", settings.messages_quick_replies_budget
+                )
+                else []
+            )
+            yield server_sent_event("quickReplies", quick_replies)
+        yield server_sent_event("done", {})
+        print(f"messages stream time elapsed: {time.time() - start_time:.2f}s")
+    except InvalidHistoryException:
+        yield server_sent_event("error", {"status": 404, "detail": "Invalid history_id."})
+    except InvalidChatIdException:
+        yield server_sent_event(
+            "error", {"status": 404, "detail": "Invalid chat id or not found."}
+        )
+    except UnauthorizedUserEditingHistoryException:
+        yield server_sent_event(
+            "error", {"status": 403, "detail": "Unauthorized user editing history"}
+        )
+    except Exception as ex:  # pylint: disable=broad-exception-caught
+        # Safeguard server from crashing.
+        print(ex)
+        yield server_sent_event(
+            "error", {"status": 500, "detail": "Internal server error"}
+        )
+
+
+@messages_router.post("/stream", dependencies=[Depends(admission["chat"])])
+async def messages_stream(
+    request: MessagesRequest,
+    user: Annotated[str, Depends(get_current_user_optional)],
+) -> StreamingResponse:
+    """Takes list of messages and streams response from assistant as server-sent
+    events: "token" for every piece of the reply, then "attachments", "chat"
+    (stored chat and reply message), "quickReplies" and "done".
+    Errors during the stream are sent as "error" event."""
+    # Excluding prompt, request.messages must be odd length
+    # because assistant has not responded yet.
+    if (len(request.messages) % 2) == 0:
+        raise HTTPException(status_code=400, detail=str("User's message missing."))
+
+    school_id = user.schoolId if user and user.schoolId else None
+    return StreamingResponse(
+        stream_events(request, user, school_id),
+        media_type="text/event-stream",
+        # Content-Encoding keeps GZipMiddleware from buffering the stream
+        headers={"Cache-Control": "no-cache", "Content-Encoding": "identity"},
+    )
+
+
+@messages_router.post(
+    "/audio",
+    response_model_exclude_none=True,
+    dependencies=[Depends(admission["audio"])],
+)
 async def messages_audio(
     audio_file: UploadFile,
     user: Annotated[str, Depends(get_current_user_optional)],
@@ -1,5 +1,9 @@
 """API schemas"""
-from pydantic import BaseModel
+from typing import Literal
+from pydantic import BaseModel, Field, validator
+
+# Messages of all queries of a batch search, they are embedded and scored together
+max_batch_messages = 2048
 
 
 class MessageAttachment(BaseModel):
@@ -26,6 +30,37 @@ class SearchQuery(BaseModel):
     """Query to search index accepts list of messages"""
 
     messages: list[Message]
+    # Number of documents to return
+    k: int = Field(10, ge=1, le=100)
+    # Minimal similarity of documents returned, search engine default if not set
+    threshold: float | None = Field(None, ge=-1, le=1)
+    # Document fields to return, all fields if not set
+    fields: list[
+        Literal[
+            "id",
+            "url",
+            "title",
+            "type",
+            "school_id",
+            "metadata",
+            "image_metadata",
+            "content",
+            "summary",
+        ]
+    ] | None = None
+
+
+class BatchSearchQuery(BaseModel):
+    """Batch of queries to search index, searched at once"""
+
+    queries: list[SearchQuery] = Field(..., max_items=1000)
+
+    @validator("queries")
+    def limit_messages(cls, queries):  # pylint: disable=no-self-argument
+        """Bound number of messages of all queries"""
+        if sum(len(query.messages) for query in queries) > max_batch_messages:
+            raise ValueError(f"At most {max_batch_messages} messages per batch")
+        return queries
 
 
 class Chat(BaseModel):
@@ -40,6 +75,8 @@ class MessagesRequest(BaseModel):
 
     chat: Chat | None = None
     messages: list[Message] = []
+    # Seconds to answer in, overrides default deadline
+    deadline: float | None = Field(None, gt=0, le=60)
 
 
 class MessagesResponse(BaseModel):
@@ -48,6 +85,15 @@ class MessagesResponse(BaseModel):
     chat: Chat | None = None
     messages: list[Message] = []
     quickReplies: list[str] = []
+    # Message id to fetch deferred quick replies with
+    quickRepliesTicket: str | None = None
+
+
+class QuickRepliesResponse(BaseModel):
+    """Deferred quick replies, empty while pending"""
+
+    status: Literal["pending", "ready"]
+    quickReplies: list[str] = []
 
 
 class History(BaseModel):
@@ -62,6 +108,22 @@ class History(BaseModel):
         fields = {"user_id": {"exclude": True}}
 
 
+class ChatSummary(BaseModel):
+    """Chat without its messages"""
+
+    id: int
+    summary: str | None = None
+    # Time of last message
+    updatedAt: float
+
+
+class ChatSummariesResponse(BaseModel):
+    """Page of user's chats, next page starts at nextCursor"""
+
+    chats: list[ChatSummary]
+    nextCursor: str | None = None
+
+
 class HistoryResponse(BaseModel):
     """History response holds all histories available for user"""
 
@@ -3,7 +3,7 @@
 """
 
 from fastapi import APIRouter
-from api.db.schools import schools_db
+from api.db.schools import async_schools_db
 
 from api.endpoints.schemas import School, SchoolsResponse
 
@@ -13,7 +13,7 @@ schools_router = APIRouter(prefix="/schools", tags=[""])
 @schools_router.get("/")
 async def schools() -> SchoolsResponse:
     """Returns a list of all the stored schools"""
-    schools_get = schools_db.get_schools()
+    schools_get = await async_schools_db.get_schools()
     schools_list = []
     for row in schools_get:
         id_value, title, short_name, url = row
@@ -1,25 +1,42 @@
 """Search endpoint"""
+import asyncio
+import hashlib
 import math
+import os
 import re
 from collections import Counter
 import numpy as np
-import openai
 from fastapi import APIRouter, Depends
 from typing_extensions import Annotated
-from scipy import spatial
 from pydantic import BaseModel
 from settings import settings
 
 # Index
-from se_indexing.db_engine.config import get_database
+from se_indexing.db_engine.config import get_database, ann_path, matrix_path
+from se_indexing.db_engine.config import path as index_path
+from se_indexing.db_engine.ann import IVFIndex
 from se_indexing.db_engine.db import DocumentEntry
+from se_indexing.db_engine.matrix import (
+    NO_SCHOOL,
+    QUERY_CHUNK_SIZE,
+    EmbeddingMatrix,
+    normalize_rows,
+    top_k,
+)
 
 # API
+from api.cache.embeddings import embedding_cache, embedding_key
+from api.db.history import async_history_db
+from api.upstream.openai_gateway import openai_gateway
+from api.upstream.single_flight import request_key, single_flight
+from api.endpoints.admission import admission
 from api.endpoints.user import get_current_user_optional
-from api.endpoints.schemas import SearchQuery, MessagesRequest
+from api.endpoints.schemas import SearchQuery, BatchSearchQuery, MessagesRequest
 
 
-search_router = APIRouter(prefix="/search", tags=[""])
+search_router = APIRouter(
+    prefix="/search", tags=[""], dependencies=[Depends(admission["embeddings"])]
+)
 
 
 class SearchDocument(BaseModel):
@@ -35,6 +52,12 @@ class SearchResult(BaseModel):
     documents: list[SearchDocument]
 
 
+class BatchSearchResult(BaseModel):
+    """Search results in order of batch queries"""
+
+    results: list[SearchResult]
+
+
 WORD = re.compile(r"\w+")
 
 
@@ -56,17 +79,220 @@ def cosine_similarity_for_attachments(vec1, vec2):
     return float(numerator) / denominator
 
 
+def fuse_embeddings(embeddings, decay: float) -> np.ndarray:
+    """Mean of normalized embeddings, each weighted decay times the next one"""
+    embeddings = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+    weights = decay ** np.arange(len(embeddings) - 1, -1, -1, dtype=np.float32)
+    return weights @ embeddings / weights.sum()
+
+
+class LexicalIndex:
+    """Inverted index of summary word counts with precomputed vector norms"""
+
+    def __init__(self, summaries: list[str]):
+        postings = {}
+        self.norms = np.zeros(len(summaries))
+        for row, summary in enumerate(summaries):
+            vector = generate_vectors(summary)
+            self.norms[row] = math.sqrt(sum(count**2 for count in vector.values()))
+            for word, count in vector.items():
+                rows, counts = postings.setdefault(word, ([], []))
+                rows.append(row)
+                counts.append(count)
+        # Word -> (rows of summaries containing the word, word counts in them)
+        self.postings = {
+            word: (np.array(rows), np.array(counts, dtype=float))
+            for word, (rows, counts) in postings.items()
+        }
+
+    def similarities(self, text: str):
+        """Cosine similarity of text against summaries sharing a word with it.
+        Returns rows of those summaries and their similarities."""
+        vector = generate_vectors(text)
+        known = [word for word in vector if word in self.postings]
+        if not known:
+            return np.zeros(0, dtype=int), np.zeros(0)
+        rows = np.concatenate([self.postings[word][0] for word in known])
+        products = np.concatenate(
+            [self.postings[word][1] * vector[word] for word in known]
+        )
+        rows, positions = np.unique(rows, return_inverse=True)
+        numerators = np.bincount(positions, weights=products)
+        text_norm = math.sqrt(sum(count**2 for count in vector.values()))
+        return rows, numerators / (self.norms[rows] * text_norm)
+
+
 default_school_id = 1
+default_threshold = 0.815
+# Maximal number of texts embedded in a single request
+embedding_batch_size = 2048
+
+
+def index_version() -> tuple:
+    """Modification times of index files, they change once indexer rebuilds it"""
+    return tuple(
+        os.path.getmtime(file) if os.path.exists(file) else None
+        for file in (index_path, f"{matrix_path}.npy", ann_path)
+    )
+
+
+class SearchIndex:
+    """Documents and search structures loaded from index together. They are
+    not modified once loaded, a rebuilt index is loaded into a new object."""
+
+    def __init__(self, database):
+        self.database = database
+        self.version = index_version()
+        # Row i of the matrix holds embedding of self.documents[i]
+        self.documents, self.matrix = self.get_documents_from_index()
+        self.lexical_index = LexicalIndex(
+            [document.summary for document in self.documents]
+        )
+        if settings.search_lazy_documents:
+            # Matrix alone keeps ids and school fields of documents
+            self.documents = None
+        self.ann_index = self.get_ann_index()
+        # Digests of general documents and of own documents of every school,
+        # computed up front as hashing every embedding takes a while
+        self.general_digest, self.school_digests = (
+            self.get_digests() if settings.answer_cache else (None, {})
+        )
+
+    def get_documents_from_index(self):
+        """Get documents from database for Searching, along with their embeddings.
+        Only search related fields are loaded in lazy documents mode.
+        Embeddings are memory-mapped from the matrix saved by the indexer if it
+        matches the database, otherwise they are loaded from the database."""
+        get_documents = (
+            self.database.get_search_entries
+            if settings.search_lazy_documents
+            else self.database.get_documents
+        )
+        matrix = EmbeddingMatrix.load(matrix_path)
+        if matrix is not None:
+            documents = {
+                document.id: document for document in get_documents(with_embeddings=False)
+            }
+            if documents.keys() == set(matrix.ids):
+                return [documents[document_id] for document_id in matrix.ids], matrix
+            print("Embedding matrix does not match documents, loading embeddings")
+        documents = get_documents()
+        return documents, EmbeddingMatrix.from_documents(documents)
+
+    def get_ann_index(self) -> IVFIndex | None:
+        """Load IVF index built by the indexer if approximate search is enabled"""
+        if not settings.search_ann or not os.path.exists(ann_path):
+            return None
+        ann_index = IVFIndex.load(ann_path, self.matrix.ids)
+        if ann_index is None:
+            print("IVF index does not match documents, using exact search")
+        return ann_index
+
+    def digest(self, rows) -> str:
+        """Digest of ids and embeddings of documents at matrix rows"""
+        digest = hashlib.sha256()
+        for start in range(0, len(rows), embedding_batch_size):
+            batch = rows[start : start + embedding_batch_size]
+            digest.update("\n".join(self.matrix.ids[row] for row in batch).encode())
+            digest.update(self.matrix.embeddings[batch].tobytes())
+        return digest.hexdigest()
+
+    def get_digests(self) -> tuple[str, dict[int, str]]:
+        """Digest of general documents, and digests of documents of every
+        school that aren't general, by school id"""
+        own_rows = np.flatnonzero(~self.matrix.general)
+        school_ids = self.matrix.school_ids[own_rows]
+        order = np.argsort(school_ids, kind="stable")
+        schools, starts = np.unique(school_ids[order], return_index=True)
+        return self.digest(np.flatnonzero(self.matrix.general)), {
+            int(school): self.digest(rows)
+            for school, rows in zip(schools, np.split(own_rows[order], starts[1:]))
+        }
+
+    def school_fingerprint(self, school_id: int | None) -> str:
+        """Digest of ids and embeddings of documents visible for school,
+        changes once they are reindexed"""
+        own_digest = self.school_digests.get(
+            NO_SCHOOL if school_id is None else school_id, ""
+        )
+        return hashlib.sha256(f"{self.general_digest}\n{own_digest}".encode()).hexdigest()
+
+    def get_documents(self, rows, fields: list[str] = None) -> list[DocumentEntry]:
+        """Documents at given matrix rows. In lazy documents mode they are
+        fetched from index database with given fields only, missing documents
+        are None."""
+        if self.documents is not None:
+            return [self.documents[row] for row in rows]
+        document_ids = [self.matrix.ids[row] for row in rows]
+        documents = self.database.get_documents_by_ids(list(set(document_ids)), fields)
+        # Documents removed from index since it was loaded are None
+        return [documents.get(document_id) for document_id in document_ids]
+
+    def similarities(self, embeddings, school_id=default_school_id):
+        """Cosine similarity of every embedding against documents visible for
+        school. Returns (rows, similarities) of scored documents per embedding."""
+        if len(embeddings) == 0:
+            return []
+        if self.ann_index is None:
+            rows, similarities = self.matrix.similarities(embeddings, school_id)
+            return [(rows, scores) for scores in similarities]
+        return self.ann_index.similarities(
+            self.matrix, embeddings, school_id, settings.search_ann_probes
+        )
+
+    def rank_documents(
+        self,
+        candidates,
+        k: int | None = None,
+        threshold: float = default_threshold,
+        fields: list[str] = None,
+    ) -> list[SearchDocument]:
+        """Merge best matches of every embedding scored by similarities()
+        into a single ranking of documents"""
+        if len(candidates) == 0:
+            return []
+        matches = [top_k(scores, k, threshold) for _, scores in candidates]
+        found_rows = np.concatenate(
+            [rows[positions] for (rows, _), positions in zip(candidates, matches)]
+        )
+        found_similarities = np.concatenate(
+            [scores[positions] for (_, scores), positions in zip(candidates, matches)]
+        )
+        order = top_k(found_similarities, k)
+        return [
+            SearchDocument(document=document, similarity=similarity)
+            for document, similarity in zip(
+                self.get_documents(found_rows[order], fields),
+                found_similarities[order],
+            )
+            if document is not None
+        ]
 
 
 class SearchEngine:
     """Search engine"""
 
-    documents = []
-
     def __init__(self):
-        openai.api_key = settings.openai_key
-        self.documents = self.get_documents_from_index()
+        # Shared with the thread loading a rebuilt index
+        self.database = get_database(check_same_thread=False)
+        # Index built by an older indexer gets indexes of current schema
+        self.database.create_database_if_not_exists()
+        self.index = SearchIndex(self.database)
+
+    async def refresh(self) -> bool:
+        """Reload index if the indexer rebuilt it since it was loaded. The new
+        index is loaded on another thread and replaces the old one at once,
+        requests keep using the old one meanwhile."""
+        if index_version() == self.index.version:
+            return False
+        print("Index changed, reloading")
+        self.index = await asyncio.to_thread(SearchIndex, self.database)
+        return True
+
+    def school_fingerprint(self, school_id: int | None) -> str:
+        """Digest of ids and embeddings of documents visible for school,
+        changes once they are reindexed"""
+        return self.index.school_fingerprint(school_id)
 
     def should_search_docs(
         self,
@@ -75,71 +301,158 @@ class SearchEngine:
         school_id=default_school_id,
         documents_entries: list = None,
     ) -> bool:
-        """Function for comparing texts and check if it fit for requirements"""
-        if documents_entries is None:
-            documents_entries = self.documents
-        msg_vector = generate_vectors(content)
+        """Function for comparing texts and check if it fit for requirements.
+        Indexed documents are used unless documents_entries are given."""
         max_cosine = 0
-        for document in documents_entries:
-            if document.school_id == school_id or document.type == "general":
-                doc_vector = generate_vectors(document.summary)
-                cosine = cosine_similarity_for_attachments(doc_vector, msg_vector)
-                max_cosine = max(cosine, max_cosine)
+        if documents_entries is None:
+            index = self.index
+            rows, cosines = index.lexical_index.similarities(content)
+            cosines = cosines[index.matrix.school_mask(school_id)[rows]]
+            max_cosine = cosines.max(initial=0)
+        else:
+            msg_vector = generate_vectors(content)
+            for document in documents_entries:
+                if document.school_id == school_id or document.type == "general":
+                    doc_vector = generate_vectors(document.summary)
+                    cosine = cosine_similarity_for_attachments(doc_vector, msg_vector)
+                    max_cosine = max(cosine, max_cosine)
         print("text similarity:", max_cosine, 'for "' + content + '"')
         return max_cosine > threshold
 
-    def get_documents_from_index(self):
-        """Get documents from database for Searching"""
-        database = get_database()
-        documents = database.get_documents()
-        return documents
-
-    def generate_embeddings(self, query: SearchQuery):
-        """Generating embeddings for message content"""
-        vectors = []
-        for message in query.messages:
-            response = openai.Embedding.create(
-                input=[message.content], model="text-embedding-ada-002"
+    async def generate_embeddings(self, query: SearchQuery, chat_id: int | None = None):
+        """Generating embeddings for message content. If chat id is given,
+        embeddings stored with the chat are reused and new ones are stored,
+        the rest are embedded in a single request."""
+        keys = [
+            embedding_key(settings.embedding_model, message.content)
+            for message in query.messages
+        ]
+        stored = await async_history_db.get_embeddings(chat_id) if chat_id else {}
+        vectors = [stored.get(key) for key in keys]
+        missing = [index for index, vector in enumerate(vectors) if vector is None]
+        if not missing:
+            return vectors
+
+        embedded = await self.generate_embeddings_batch(
+            [query.messages[index].content for index in missing]
+        )
+        for index, vector in zip(missing, embedded):
+            vectors[index] = vector
+        if chat_id:
+            await async_history_db.add_embeddings(
+                chat_id, {keys[index]: vectors[index] for index in missing}
             )
-            vector = response["data"][0]["embedding"]
-            vectors.append(np.array(vector))
         return vectors
 
-    def search_documents(self, embeddings, school_id=default_school_id):
+    async def generate_embeddings_batch(self, texts: list[str]) -> np.ndarray:
+        """Generating embeddings for many texts at once. Texts missing from
+        cache are embedded in one request per embedding_batch_size texts."""
+        vectors = await embedding_cache.get_many(settings.embedding_model, texts)
+        missing = [index for index, vector in enumerate(vectors) if vector is None]
+        for start in range(0, len(missing), embedding_batch_size):
+            batch = missing[start : start + embedding_batch_size]
+            batch_texts = [texts[index] for index in batch]
+            response = await single_flight.do(
+                request_key("embeddings", settings.embedding_model, batch_texts),
+                openai_gateway.embedding,
+                input=batch_texts,
+                model=settings.embedding_model,
+            )
+            for item in response["data"]:
+                vectors[batch[item["index"]]] = item["embedding"]
+            await embedding_cache.put_many(
+                settings.embedding_model,
+                batch_texts,
+                [vectors[index] for index in batch],
+            )
+        return np.array(vectors, dtype=np.float32)
+
+    def search_documents(
+        self,
+        embeddings,
+        school_id=default_school_id,
+        k: int | None = None,
+        threshold: float = default_threshold,
+        fields: list[str] = None,
+    ) -> list[SearchDocument]:
         """Calculating cosine similarity,
-        searching and sorting most similar and relevant documents"""
-        similar_documents = []
-        max_cosine = 0
-        for embedding in embeddings:
-            for document in self.documents:
-                if document.school_id == school_id or document.type == "general":
-                    threshold = 0.815
-                    cosine_similarity = 1 - spatial.distance.cosine(
-                        embedding.T, document.embedding.T
+        searching and sorting most similar and relevant documents.
+        Documents found may hold only given fields in lazy documents mode."""
+        # Documents are ranked with the index they were scored with
+        index = self.index
+        candidates = index.similarities(embeddings, school_id)
+        print(
+            "      embedding:",
+            max((scores.max(initial=0) for _, scores in candidates), default=0),
+        )
+        return index.rank_documents(candidates, k, threshold, fields)
+
+    def search_documents_batch(
+        self, queries: list[SearchQuery], embeddings, school_id=default_school_id
+    ) -> list[list[SearchDocument]]:
+        """Documents found for every query, given embeddings of messages of all
+        queries in order. Queries are scored a few at a time, so that
+        similarities of only QUERY_CHUNK_SIZE messages are held at once."""
+        index = self.index
+        offsets = [0]
+        for query in queries:
+            offsets.append(offsets[-1] + len(query.messages))
+
+        results = []
+        first = 0
+        while first < len(queries):
+            last = first + 1
+            while (
+                last < len(queries)
+                and offsets[last + 1] - offsets[first] <= QUERY_CHUNK_SIZE
+            ):
+                last += 1
+            candidates = index.similarities(
+                embeddings[offsets[first] : offsets[last]], school_id
+            )
+            for number in range(first, last):
+                query = queries[number]
+                threshold = query.threshold
+                position = offsets[number] - offsets[first]
+                results.append(
+                    index.rank_documents(
+                        candidates[position : position + len(query.messages)],
+                        k=query.k,
+                        threshold=default_threshold if threshold is None else threshold,
+                        fields=query.fields,
                     )
-                    max_cosine = max(cosine_similarity, max_cosine)
-                    if cosine_similarity > threshold:
-                        similar_documents.append(
-                            SearchDocument(
-                                document=document, similarity=cosine_similarity
-                            )
-                        )
-                else:
-                    pass
-            response = sorted(similar_documents, key=lambda x: x.similarity, reverse=True)
-        print("      embedding:", max_cosine)
-        return response
+                )
+            first = last
+        return results
+
+    def should_search_request(
+        self, request: MessagesRequest, school_id=default_school_id
+    ) -> bool:
+        """Whether latest message of conversation is close enough to documents"""
+        return self.should_search_docs(request.messages[-1].content, 0.155, school_id)
+
+    async def request_embeddings(
+        self, request: MessagesRequest, chat_id: int | None = None
+    ):
+        """Embeddings to search documents for conversation with. Embeddings
+        of messages are kept with chat if its id is given, it has to be
+        a chat of the user making request."""
+        embeddings = await self.generate_embeddings(request, chat_id)
+        if settings.search_query_fusion:
+            # Single query finds every document once, scanning index once
+            embeddings = [fuse_embeddings(embeddings, settings.search_fusion_decay)]
+        return embeddings
 
     async def search_text_vectors(
         self,
         request: MessagesRequest,
         school_id=default_school_id,
+        k: int | None = None,
     ) -> list[SearchDocument]:
         """Function for call text comparing and search engine"""
-        message_content = request.messages[-1].content
-        if self.should_search_docs(message_content, 0.155, school_id, self.documents):
-            embeddings = self.generate_embeddings(request)
-            return self.search_documents(embeddings, school_id)
+        if self.should_search_request(request, school_id):
+            embeddings = await self.request_embeddings(request)
+            return self.search_documents(embeddings, school_id, k)
         return []
 
     def get_system_message(self, document):
@@ -155,13 +468,63 @@ class SearchEngine:
 search_engine = SearchEngine()
 
 
+async def refresh_index_periodically(interval: float):
+    """Reload index every interval seconds if it was rebuilt"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await search_engine.refresh()
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            # Keep serving previously loaded index
+            print(f"Failed to reload index: {ex}")
+
+
 @search_router.post("/", response_model=None)
 async def search_documents(
     query: SearchQuery, current_user: Annotated[str, Depends(get_current_user_optional)]
 ) -> SearchResult:
-    """POST request with 10 relevant documents"""
+    """POST request with k (10 by default) relevant documents,
+    holding only requested fields if any"""
     school_id = current_user.schoolId if current_user and current_user.schoolId else None
-    embeddings = search_engine.generate_embeddings(query)
+    embeddings = await search_engine.generate_embeddings(query)
     print('Searching for "' + query.messages[-1].content + '"')
-    similar_documents = search_engine.search_documents(embeddings, school_id)[:10]
-    return SearchResult(documents=similar_documents)
+    similar_documents = search_engine.search_documents(
+        embeddings,
+        school_id,
+        k=query.k,
+        threshold=default_threshold if query.threshold is None else query.threshold,
+        fields=query.fields,
+    )
+    return search_result(similar_documents, query.fields)
+
+
+@search_router.post("/batch", response_model=None)
+async def search_documents_batch(
+    batch: BatchSearchQuery,
+    current_user: Annotated[str, Depends(get_current_user_optional)],
+) -> BatchSearchResult:
+    """POST request with relevant documents for every query in batch.
+    Messages of all queries are embedded together and scored in chunks."""
+    school_id = current_user.schoolId if current_user and current_user.schoolId else None
+    embeddings = await search_engine.generate_embeddings_batch(
+        [message.content for query in batch.queries for message in query.messages]
+    )
+    print(f"Searching for {len(batch.queries)} queries")
+    documents = await asyncio.to_thread(
+        search_engine.search_documents_batch, batch.queries, embeddings, school_id
+    )
+    results = [
+        search_result(similar_documents, query.fields)
+        for query, similar_documents in zip(batch.queries, documents)
+    ]
+    return BatchSearchResult.construct(results=results)
+
+
+def search_result(documents: list[SearchDocument], fields: list[str] | None):
+    """Search result holding only given document fields, if any"""
+    result = SearchResult(documents=documents)
+    if fields is None:
+        return result
+    return result.dict(
+        include={"documents": {"__all__": {"document": set(fields), "similarity": True}}}
+    )
@@ -4,7 +4,7 @@ import jwt
 from fastapi import APIRouter, Security, HTTPException, status
 from fastapi.security.api_key import APIKeyHeader
 from pydantic import BaseModel
-from api.db.users import users_db
+from api.db.users import async_users_db
 
 SECRET_KEY = "temporary_secret_key_73857982"
 
@@ -72,7 +72,7 @@ async def get_current_user(token: str = Security(APIKeyHeader(name="Authorizatio
         raise credentials_exception from error
 
     check_email(token_data.email)
-    db_user = users_db.get_user(token_data.email)
+    db_user = await async_users_db.get_user(token_data.email)
     if db_user is None:
         raise credentials_exception
 
@@ -7,7 +7,7 @@ from fastapi import HTTPException, status
 from pydantic import BaseModel
 
 from api.endpoints.user import user_router, User, get_token, check_email
-from api.db.users import users_db, get_pass_hash
+from api.db.users import async_users_db, get_pass_hash
 
 
 class UserRequest(BaseModel):
@@ -51,7 +51,7 @@ async def authenticate_user(credentials: AuthRequest) -> AuthResponse:
         )
 
         check_email(credentials.email)
-        user = users_db.get_user(credentials.email)
+        user = await async_users_db.get_user(credentials.email)
 
         if user is None:
             raise existence_exception
@@ -80,16 +80,16 @@ async def register_user(user: UserRequest) -> AuthResponse:
             detail="User already exists",
         )
 
-        db_user = users_db.get_user(user.email)
+        db_user = await async_users_db.get_user(user.email)
         if db_user is None:
             check_email(user.email)
 
-            user_id = users_db.add_user(user)
+            user_id = await async_users_db.add_user(user)
 
             token = get_token(user_id, user.email)
-            users_db.add_token(user_id, token)
+            await async_users_db.add_token(user_id, token)
 
-            db_user = users_db.get_user(user.email)
+            db_user = await async_users_db.get_user(user.email)
 
             return AuthResponse(
                 token=token,
@@ -1,12 +1,20 @@
 """
     Initialize FastAPI
 """
+import asyncio
+
 from fastapi import FastAPI
 from starlette.middleware.cors import CORSMiddleware
 from starlette.middleware.gzip import GZipMiddleware
 from fastapi_pagination import add_pagination
 
+from api.db.connection import close_connections
+from api.db.executor import database_executor
+from api.db.history import async_history_db
 from api.routes import api_router
+from api.endpoints.search import refresh_index_periodically
+from api.upstream.openai_gateway import openai_gateway
+from settings import settings
 
 app = FastAPI(debug=True)
 app.add_middleware(GZipMiddleware)
@@ -20,3 +28,37 @@ app.add_middleware(
 
 app.include_router(api_router)
 add_pagination(app)
+# Tasks running while the app is up
+background_tasks = set()
+
+
+async def migrate_message_blobs():
+    """Move chat messages still stored as blobs to one row per message,
+    a few chats at a time so that requests are served meanwhile"""
+    while await async_history_db.migrate_message_blobs(100):
+        # Writes of requests queued meanwhile go first on the writer thread
+        await asyncio.sleep(0.01)
+
+
+@app.on_event("startup")
+async def startup():
+    """Start database threads and background tasks of the app"""
+    database_executor.start()
+    background_tasks.add(asyncio.ensure_future(migrate_message_blobs()))
+    if settings.search_refresh_interval:
+        task = asyncio.ensure_future(
+            refresh_index_periodically(settings.search_refresh_interval)
+        )
+        background_tasks.add(task)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Stop background tasks and close connections kept open by the app"""
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    await openai_gateway.close()
+    # Running database calls finish before their connections are closed
+    await asyncio.to_thread(database_executor.shutdown)
+    close_connections()
@@ -0,0 +1,105 @@
+"""Asynchronous gateway for OpenAI API calls made by the API"""
+import asyncio
+
+import aiohttp
+import openai
+
+from settings import settings
+
+openai.api_key = settings.openai_key
+
+
+class OpenAIGateway:
+    """Awaitable OpenAI calls sharing one pooled HTTP session.
+    Every call has a timeout and calls to each endpoint are limited
+    to max_concurrency at a time."""
+
+    def __init__(self, timeout: float, max_concurrency: int, pool_size: int):
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.session = None
+        self.semaphores = {
+            endpoint: asyncio.Semaphore(max_concurrency)
+            for endpoint in ("chat", "embeddings", "audio")
+        }
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """Pooled HTTP session, created on first use"""
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size)
+            )
+        return self.session
+
+    async def close(self):
+        """Close pooled HTTP session"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def call(self, endpoint: str, request, *args, timeout=None, **kwargs):
+        """Await OpenAI request once endpoint has a free slot"""
+        openai.aiosession.set(self.get_session())
+        async with self.semaphores[endpoint]:
+            return await asyncio.wait_for(
+                request(*args, **kwargs),
+                self.timeout if timeout is None else timeout,
+            )
+
+    async def chat_completion(self, timeout: float = None, **kwargs):
+        """openai.ChatCompletion.create counterpart"""
+        return await self.call(
+            "chat", openai.ChatCompletion.acreate, timeout=timeout, **kwargs
+        )
+
+    async def read_stream(self, queue: asyncio.Queue, timeout: float, kwargs: dict):
+        """Put chunks of streamed chat completion into queue, None after the last"""
+        openai.aiosession.set(self.get_session())
+        try:
+            async with self.semaphores["chat"]:
+                chunks = await asyncio.wait_for(
+                    openai.ChatCompletion.acreate(stream=True, **kwargs),
+                    self.timeout if timeout is None else timeout,
+                )
+                async for chunk in chunks:
+                    queue.put_nowait(chunk)
+        finally:
+            queue.put_nowait(None)
+
+    async def chat_completion_stream(self, timeout: float = None, **kwargs):
+        """openai.ChatCompletion.create counterpart yielding streamed chunks.
+        Timeout applies to the start of the stream. Chunks are read as soon
+        as upstream sends them, so the endpoint slot is released once upstream
+        is done however slowly they are consumed."""
+        queue = asyncio.Queue()
+        reader = asyncio.ensure_future(self.read_stream(queue, timeout, kwargs))
+        try:
+            chunk = await queue.get()
+            while chunk is not None:
+                yield chunk
+                chunk = await queue.get()
+            # Raise error that ended the stream, if any
+            await reader
+        finally:
+            reader.cancel()
+            await asyncio.gather(reader, return_exceptions=True)
+
+    async def embedding(self, timeout: float = None, **kwargs):
+        """openai.Embedding.create counterpart"""
+        return await self.call(
+            "embeddings", openai.Embedding.acreate, timeout=timeout, **kwargs
+        )
+
+    async def transcribe(self, model: str, file, timeout: float = None, **kwargs):
+        """openai.Audio.transcribe counterpart"""
+        return await self.call(
+            "audio", openai.Audio.atranscribe, model, file, timeout=timeout, **kwargs
+        )
+
+
+# OpenAIGateway singleton
+openai_gateway = OpenAIGateway(
+    settings.openai_timeout,
+    settings.openai_max_concurrency,
+    settings.openai_pool_size,
+)
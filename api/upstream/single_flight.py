@@ -0,0 +1,67 @@
+"""Coalescing of identical concurrent upstream calls"""
+import asyncio
+import hashlib
+import json
+
+from settings import settings
+
+
+def request_key(*parts) -> str:
+    """Key identifying a call by JSON serializable parts of its request"""
+    return hashlib.sha256(
+        json.dumps(parts, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+class SingleFlight:
+    """Runs one call per key at a time. Calls made while a call with the same
+    key is in flight await its result instead of calling upstream again."""
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        # key -> task of call in flight
+        self.calls = {}
+        self.started = 0
+        self.coalesced = 0
+
+    def forget(self, key: str, task: asyncio.Task):
+        """Remove finished call, retrieving its error if nobody awaited it"""
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key: str, function, *args, **kwargs):
+        """Await function(*args, **kwargs), sharing the call with concurrent
+        callers using the same key. A caller being cancelled doesn't cancel
+        the call for the others."""
+        result, _ = await self.do_joined(key, function, *args, **kwargs)
+        return result
+
+    async def do_joined(self, key: str, function, *args, **kwargs):
+        """Like do, also return whether the caller joined a call started by
+        another caller, and so got the same result as that caller"""
+        if not self.enabled:
+            return await function(*args, **kwargs), False
+        task = self.calls.get(key)
+        joined = task is not None
+        if joined:
+            self.coalesced += 1
+        else:
+            self.started += 1
+            task = asyncio.ensure_future(function(*args, **kwargs))
+            self.calls[key] = task
+            task.add_done_callback(lambda task: self.forget(key, task))
+        return await asyncio.shield(task), joined
+
+    def stats(self) -> dict:
+        """Calls made upstream and calls served by a call already in flight"""
+        return {
+            "in_flight": len(self.calls),
+            "started": self.started,
+            "coalesced": self.coalesced,
+        }
+
+
+# SingleFlight singleton for OpenAI calls
+single_flight = SingleFlight(settings.openai_single_flight)
@@ -0,0 +1,131 @@
+"""Recall and latency of IVF index compared to exact search"""
+import sqlite3
+import time
+from argparse import ArgumentParser
+from contextlib import closing
+
+import numpy as np
+from db_engine.config import get_database
+from db_engine.matrix import EmbeddingMatrix, NO_SCHOOL, top_k
+from db_engine.ann import IVFIndex
+
+
+def measure(search, queries, k):
+    """Run search for every query, return found rows and latencies in ms"""
+    found = []
+    latencies = []
+    for query in queries:
+        start_time = time.perf_counter()
+        rows, similarities = search(query)
+        found.append(rows[top_k(similarities, k)])
+        latencies.append((time.perf_counter() - start_time) * 1000)
+    return found, np.array(latencies)
+
+
+def held_out_split(matrix: EmbeddingMatrix, count: int, rng):
+    """Remove count random documents from matrix. Returns matrix of the rest,
+    every one of them visible, and embeddings of removed documents."""
+    rows = rng.permutation(len(matrix))
+    held_out, kept = rows[:count], np.sort(rows[count:])
+    kept_matrix = EmbeddingMatrix(
+        matrix.embeddings[kept], matrix.school_ids[kept], np.ones(len(kept), dtype=bool)
+    )
+    return kept_matrix, matrix.embeddings[held_out]
+
+
+def cached_queries(path: str, count: int, rng) -> np.ndarray:
+    """Up to count embeddings of real queries kept in SQLite embedding cache"""
+    with closing(sqlite3.connect(path)) as connection:
+        rows = connection.execute("SELECT embedding FROM embedding_cache").fetchall()
+    queries = np.array([np.frombuffer(row[0], dtype=np.float32) for row in rows])
+    if len(queries) > count:
+        queries = queries[rng.choice(len(queries), count, replace=False)]
+    return queries
+
+
+def main():
+    """Report recall@k and latency for a range of probed lists"""
+    parser = ArgumentParser(prog="IVF index report")
+    parser.add_argument("-k", type=int, default=10, help="Number of results per query.")
+    parser.add_argument(
+        "--lists", type=int, default=None, help="IVF lists, square root of size if unset."
+    )
+    parser.add_argument(
+        "--probes",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8, 16, 32],
+        help="Lists probed.",
+    )
+    parser.add_argument("--queries", type=int, default=200, help="Number of queries.")
+    parser.add_argument(
+        "--embedding-cache",
+        default=None,
+        help="SQLite embedding cache of the API (embedding_cache_path) to take"
+        " real queries from. Held-out documents are used as queries if unset.",
+    )
+    args = parser.parse_args()
+
+    with get_database() as database:
+        matrix = EmbeddingMatrix.from_documents(database.get_documents())
+    if len(matrix) == 0:
+        print("Index is empty.")
+        return
+    rng = np.random.default_rng(0)
+    if args.embedding_cache:
+        queries = cached_queries(args.embedding_cache, args.queries, rng)
+        # Every document is made visible, as if all of them were general
+        matrix = EmbeddingMatrix(
+            matrix.embeddings, matrix.school_ids, np.ones(len(matrix), dtype=bool)
+        )
+    else:
+        # Queries are documents left out of the index, so none of them
+        # is trivially nearest to itself
+        matrix, queries = held_out_split(matrix, min(args.queries, len(matrix) // 2), rng)
+    if len(queries) == 0:
+        print("No queries to evaluate.")
+        return
+
+    start_time = time.perf_counter()
+    index = IVFIndex.train(matrix.embeddings, args.lists)
+    print(
+        f"Trained {len(index.centroids)} lists for {len(matrix)} documents"
+        f" in {time.perf_counter() - start_time:.2f}s"
+    )
+
+    print(f"Evaluating {len(queries)} queries")
+    exact, latencies = measure(
+        lambda query: (
+            matrix.school_rows(NO_SCHOOL),
+            matrix.similarities(query, NO_SCHOOL)[1][0],
+        ),
+        queries,
+        args.k,
+    )
+    print(f"{'probes':>8} {'recall@' + str(args.k):>10} {'mean ms':>10} {'p95 ms':>10}")
+    print(
+        f"{'exact':>8} {1:>10.3f} {latencies.mean():>10.3f}"
+        f" {np.percentile(latencies, 95):>10.3f}"
+    )
+    for probes in args.probes:
+        found, latencies = measure(
+            lambda query, probes=probes: index.similarities(
+                matrix, query, NO_SCHOOL, probes
+            )[0],
+            queries,
+            args.k,
+        )
+        recall = np.mean(
+            [
+                len(np.intersect1d(rows, expected)) / len(expected)
+                for rows, expected in zip(found, exact)
+            ]
+        )
+        print(
+            f"{probes:>8} {recall:>10.3f} {latencies.mean():>10.3f}"
+            f" {np.percentile(latencies, 95):>10.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Inverted file (IVF) index for approximate nearest neighbour search"""
+import math
+
+import numpy as np
+
+from .matrix import normalize_rows
+
+# Rows scored at once while assigning vectors to lists
+CHUNK_SIZE = 65536
+
+
+def assign_lists(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Index of the most similar centroid for every vector"""
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), CHUNK_SIZE):
+        chunk = vectors[start : start + CHUNK_SIZE]
+        assignment[start : start + CHUNK_SIZE] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignment
+
+
+def train_centroids(vectors, lists: int, iterations: int = 10, seed: int = 0):
+    """Spherical k-means over a sample of unit length vectors"""
+    rng = np.random.default_rng(seed)
+    training = vectors[
+        np.sort(rng.choice(len(vectors), min(len(vectors), lists * 256), replace=False))
+    ]
+    centroids = training[rng.choice(len(training), lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = assign_lists(training, centroids)
+        counts = np.bincount(assignment, minlength=lists)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        filled = counts > 0
+        sums = np.zeros_like(centroids)
+        sums[filled] = np.add.reduceat(
+            training[np.argsort(assignment, kind="stable")], starts[filled]
+        )
+        # Restart empty lists from random training vectors
+        sums[~filled] = training[rng.choice(len(training), np.count_nonzero(~filled))]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+class IVFIndex:
+    """Documents partitioned into lists around k-means centroids.
+    A query is scored exactly against documents of its closest lists only."""
+
+    def __init__(self, centroids, offsets, rows):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        # Rows of list i are rows[offsets[i]:offsets[i + 1]]
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.rows = np.asarray(rows, dtype=np.int64)
+
+    @classmethod
+    def train(cls, embeddings: np.ndarray, lists: int | None = None):
+        """Build index over row-normalized embedding matrix.
+        Defaults to square root of document count lists."""
+        if lists is None:
+            lists = int(math.sqrt(len(embeddings)))
+        lists = max(1, min(lists, len(embeddings)))
+        centroids = train_centroids(embeddings, lists)
+        assignment = assign_lists(embeddings, centroids)
+        offsets = np.concatenate(
+            ([0], np.cumsum(np.bincount(assignment, minlength=lists)))
+        )
+        return cls(centroids, offsets, np.argsort(assignment, kind="stable"))
+
+    def save(self, path: str, ids: list[str]):
+        """Save index along with ids of documents it was built for"""
+        np.savez(
+            path,
+            centroids=self.centroids,
+            offsets=self.offsets,
+            rows=self.rows,
+            ids=np.array(ids, dtype=str),
+        )
+
+    @classmethod
+    def load(cls, path: str, ids: list[str]):
+        """Load index and map it onto documents with given ids.
+        Returns None if the index was built for other documents."""
+        with np.load(path) as data:
+            positions = {document_id: row for row, document_id in enumerate(ids)}
+            saved_ids = data["ids"]
+            if len(saved_ids) != len(ids):
+                return None
+            try:
+                rows = np.array([positions[str(id)] for id in saved_ids], dtype=np.int64)
+            except KeyError:
+                return None
+            return cls(data["centroids"], data["offsets"], rows[data["rows"]])
+
+    def similarities(self, matrix, queries, school_id: int | None, probes: int):
+        """Cosine similarity of every query against documents visible for school
+        in its closest lists. Returns (rows, similarities) per query."""
+        queries = normalize_rows(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        probes = min(probes, len(self.centroids))
+        nearest = np.argpartition(-(queries @ self.centroids.T), probes - 1, axis=1)
+        mask = matrix.school_mask(school_id)
+        results = []
+        for query, lists in zip(queries, nearest[:, :probes]):
+            rows = np.concatenate(
+                [self.rows[self.offsets[i] : self.offsets[i + 1]] for i in lists]
+            )
+            rows = rows[mask[rows]]
+            results.append((rows, matrix.embeddings[rows] @ query))
+        return results
@@ -3,10 +3,14 @@ from .db import IndexDB
 
 database = "sqlite3"
 path = "se_indexing/index.sqlite"
+ann_path = "se_indexing/index.ivf.npz"
+# Embedding matrix shared by API workers, see EmbeddingMatrix.save
+matrix_path = "se_indexing/index.matrix"
 
 
-def get_database():
-    """Gets the database connection according to configuration provided"""
+def get_database(check_same_thread=True):
+    """Gets the database connection according to configuration provided.
+    Connection may be used by other threads if check_same_thread is False."""
     if database == "sqlite3":
-        return IndexDB(path)
+        return IndexDB(path, check_same_thread)
     raise NotImplementedError(f"Database type {database} is not implemented.")
@@ -9,6 +9,7 @@ from uuid import uuid4
 import json
 import pickle
 from contextlib import closing
+from typing import NamedTuple
 from pydantic import BaseModel
 import numpy as np
 
@@ -17,6 +18,7 @@ sys.path.append(os.path.abspath(pathlib.Path(__file__).parent.parent.parent))
 os.chdir(pathlib.Path(__file__).parent.parent.parent)
 # pylint: disable=wrong-import-position)
 from api.db.schools import schools_db
+from api.db.migrations import Migration, forget_migrations, migrate
 
 
 def get_schools():
@@ -27,6 +29,20 @@ def get_schools():
     return schools
 
 
+# Columns of DocumentEntry fields stored in the database
+DOCUMENT_COLUMNS = {
+    "id": "documents.id",
+    "url": "documents.url",
+    "title": "documents.title",
+    "type": "documents.type",
+    "school_id": "documents.school_id",
+    "metadata": "documents.metadata",
+    "image_metadata": "documents.image_metadata",
+    "content": "documents.content",
+    "summary": "summaries.summary",
+}
+
+
 class DocumentEntry(BaseModel):
     """Document Entry class"""
 
@@ -66,22 +82,87 @@ class DocumentEntry(BaseModel):
             content=content,
             summary=summary,
         )
-        self.embedding = np.array(pickle.loads(embedding))
+        if embedding is not None:
+            self.embedding = np.array(pickle.loads(embedding))
+
+    @classmethod
+    def from_columns(cls, **columns):
+        """Create document holding only given fields, as stored in the database"""
+        for field in ("metadata", "image_metadata"):
+            if field in columns:
+                columns[field] = json.loads(columns[field])
+        if columns.get("school_id") is not None:
+            columns["school_id"] = int(columns["school_id"])
+        return cls.construct(**columns)
 
     class Config:
         "Config"
         fields = {"embedding": {"exclude": True}}
 
 
+class SearchEntry(NamedTuple):
+    """Document fields needed for searching only"""
+
+    id: str
+    type: str
+    school_id: int | None
+    summary: str
+    embedding: np.ndarray | None
+
+
+# Schema versions of indexing database, in order
+index_migrations = [
+    Migration(
+        "create index tables",
+        (
+            """
+            CREATE TABLE IF NOT EXISTS documents (
+                id text PRIMARY KEY,
+                url text,
+                title text,
+                school_id text,
+                type text,
+                metadata text,
+                image_metadata text,
+                content text
+            );""",
+            """
+            CREATE TABLE IF NOT EXISTS summaries (
+                id text PRIMARY KEY,
+                document_id text REFERENCES documents(id),
+                summary text
+            );""",
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                id text PRIMARY KEY,
+                summary_id text REFERENCES summaries(id),
+                type text,
+                embedding blob
+            );""",
+        ),
+    ),
+    Migration(
+        "index lookups and joins",
+        (
+            "CREATE INDEX IF NOT EXISTS documents_url ON documents (url);",
+            """CREATE INDEX IF NOT EXISTS summaries_document
+            ON summaries (document_id);""",
+            """CREATE INDEX IF NOT EXISTS embeddings_summary
+            ON embeddings (summary_id);""",
+        ),
+    ),
+]
+
+
 class IndexDB:
     """DataBase Index"""
 
     schools = get_schools()
 
-    def __init__(self, path):
+    def __init__(self, path, check_same_thread=True):
         self.path = path
 
-        self.connection = sqlite3.connect(path)
+        self.connection = sqlite3.connect(path, check_same_thread=check_same_thread)
 
     def __del__(self):
         if self.connection:
@@ -102,45 +183,19 @@ class IndexDB:
             cursor.execute("DROP TABLE IF EXISTS documents")
 
         self.connection.commit()
+        forget_migrations(self.connection, "index")
 
     def create_database_if_not_exists(self):
-        """Creates the indexing database, if it doesn't exist already."""
-        sql_create_documents_table = """
-        CREATE TABLE IF NOT EXISTS documents (
-            id text PRIMARY KEY,
-            url text,
-            title text,
-            school_id text,
-            type text,
-            metadata text,
-        	image_metadata text,
-            content text
-        );"""
-        sql_create_summaries_table = """
-        CREATE TABLE IF NOT EXISTS summaries (
-            id text PRIMARY KEY,
-            document_id text REFERENCES documents(id),
-            summary text
-        );"""
-        sql_create_embedding_table = """
-        CREATE TABLE IF NOT EXISTS embeddings (
-            id text PRIMARY KEY,
-            summary_id text REFERENCES summaries(id),
-            type text,
-            embedding blob
-        );"""
-        with closing(self.connection.cursor()) as cursor:
-            cursor.execute(sql_create_documents_table)
-            cursor.execute(sql_create_summaries_table)
-            cursor.execute(sql_create_embedding_table)
-
-        self.connection.commit()
+        """Creates the indexing database, if it doesn't exist already,
+        and brings it to the latest schema version."""
+        migrate(self.connection, "index", index_migrations)
 
-    def get_documents(self):
-        """Function for load documents into Search engine"""
+    def get_documents(self, with_embeddings=True):
+        """Function for load documents into Search engine.
+        Embedding blobs are not read if with_embeddings is False."""
         with closing(self.connection.cursor()) as cursor:
             cursor.execute(
-                """
+                f"""
                 SELECT
                     documents.id,
                     documents.url,
@@ -151,7 +206,7 @@ class IndexDB:
                     documents.image_metadata,
                     documents.content,
                     summaries.summary,
-                    embeddings.embedding
+                    {"embeddings.embedding" if with_embeddings else "NULL"}
                 FROM
                     documents
                 INNER JOIN
@@ -171,6 +226,74 @@ class IndexDB:
                 documents.append(document)
             return documents
 
+    def get_search_entries(self, with_embeddings=True):
+        """Load search related fields of documents into Search engine.
+        Embedding blobs are not read if with_embeddings is False."""
+        with closing(self.connection.cursor()) as cursor:
+            cursor.execute(
+                f"""
+                SELECT
+                    documents.id,
+                    documents.type,
+                    documents.school_id,
+                    summaries.summary,
+                    {"embeddings.embedding" if with_embeddings else "NULL"}
+                FROM
+                    documents
+                INNER JOIN
+                    summaries
+                ON
+                    summaries.document_id = documents.id
+                INNER JOIN
+                    embeddings
+                ON
+                    embeddings.summary_id = summaries.id;
+            """
+            )
+            return [
+                SearchEntry(
+                    document_id,
+                    type,
+                    None if school_id is None else int(school_id),
+                    summary,
+                    None if embedding is None else np.array(pickle.loads(embedding)),
+                )
+                for document_id, type, school_id, summary, embedding in cursor
+            ]
+
+    def get_documents_by_ids(
+        self, document_ids: list[str], fields: list[str] = None
+    ) -> dict[str, DocumentEntry]:
+        """Get documents by ids without embeddings, mapped by id.
+        If fields are given, documents hold only those fields and id."""
+        columns = [
+            column for column in DOCUMENT_COLUMNS if fields is None or column in fields
+        ]
+        if "id" not in columns:
+            columns.insert(0, "id")
+        with closing(self.connection.cursor()) as cursor:
+            cursor.execute(
+                f"""
+                SELECT
+                    {", ".join(DOCUMENT_COLUMNS[column] for column in columns)}
+                FROM
+                    documents
+                INNER JOIN
+                    summaries
+                ON
+                    summaries.document_id = documents.id
+                WHERE
+                    documents.id IN ({", ".join("?" * len(document_ids))});
+            """,
+                document_ids,
+            )
+            if fields is None:
+                return {row[0]: DocumentEntry(*row) for row in cursor.fetchall()}
+            return {
+                row[0]: DocumentEntry.from_columns(**dict(zip(columns, row)))
+                for row in cursor.fetchall()
+            }
+
     def insert_document(self, document):
         """Add document to indexing database, and return its ID."""
         document["id"] = str(uuid4())
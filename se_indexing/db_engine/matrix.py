@@ -0,0 +1,129 @@
+"""Dense embedding matrix for vectorized similarity search"""
+import os
+
+import numpy as np
+
+# School id used for documents that are not bound to any school
+NO_SCHOOL = -1
+# Queries scored against the matrix at once, bounds size of temporary products
+QUERY_CHUNK_SIZE = 64
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """Scale every row to unit length, zero rows are left as they are"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def top_k(similarities: np.ndarray, k: int | None = None, threshold: float = None):
+    """Return positions of the k highest similarities above threshold,
+    most similar first. All matches are returned if k is None."""
+    candidates = (
+        np.arange(len(similarities))
+        if threshold is None
+        else np.flatnonzero(similarities > threshold)
+    )
+    if k is not None and k < len(candidates):
+        candidates = candidates[np.argpartition(-similarities[candidates], k - 1)[:k]]
+    return candidates[np.argsort(-similarities[candidates], kind="stable")]
+
+
+class EmbeddingMatrix:
+    """Row-normalized float32 matrix holding one embedding per document,
+    along with the fields needed to filter documents by school"""
+
+    def __init__(self, embeddings, school_ids, general, ids=None):
+        self.embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        self.ids = ids
+        self.school_ids = np.asarray(school_ids, dtype=np.int64)
+        self.general = np.asarray(general, dtype=bool)
+        self._school_masks = {}
+        self._school_rows = {}
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    @classmethod
+    def from_documents(cls, documents):
+        """Build matrix from DocumentEntry list, row i belongs to documents[i].
+        Its width is that of embeddings of documents, 0 if there are none."""
+        dimensions = len(documents[0].embedding) if documents else 0
+        embeddings = np.zeros((len(documents), dimensions), dtype=np.float32)
+        for row, document in enumerate(documents):
+            embeddings[row] = document.embedding
+        return cls(
+            normalize_rows(embeddings),
+            [
+                NO_SCHOOL if document.school_id is None else document.school_id
+                for document in documents
+            ],
+            [document.type == "general" for document in documents],
+            [document.id for document in documents],
+        )
+
+    def save(self, path: str):
+        """Write matrix to path.npy and document ids with school fields
+        to path.ids.npz, each file is replaced atomically"""
+        with open(f"{path}.npy.tmp", "wb") as matrix_file:
+            np.save(matrix_file, self.embeddings)
+        with open(f"{path}.ids.npz.tmp", "wb") as ids_file:
+            np.savez(
+                ids_file,
+                ids=np.array(self.ids, dtype=str),
+                school_ids=self.school_ids,
+                general=self.general,
+            )
+        os.replace(f"{path}.npy.tmp", f"{path}.npy")
+        os.replace(f"{path}.ids.npz.tmp", f"{path}.ids.npz")
+
+    @classmethod
+    def load(cls, path: str):
+        """Memory-map matrix saved to path read-only, so that processes
+        loading it share its pages. Returns None if it's missing or incomplete."""
+        if not os.path.exists(f"{path}.npy") or not os.path.exists(f"{path}.ids.npz"):
+            return None
+        embeddings = np.load(f"{path}.npy", mmap_mode="r")
+        with np.load(f"{path}.ids.npz") as data:
+            if len(data["ids"]) != len(embeddings):
+                return None
+            return cls(
+                embeddings, data["school_ids"], data["general"], data["ids"].tolist()
+            )
+
+    def school_mask(self, school_id: int | None) -> np.ndarray:
+        """Boolean mask of documents visible for school: its own and general ones"""
+        if school_id is None:
+            school_id = NO_SCHOOL
+        mask = self._school_masks.get(school_id)
+        if mask is None:
+            mask = (self.school_ids == school_id) | self.general
+            self._school_masks[school_id] = mask
+        return mask
+
+    def school_rows(self, school_id: int | None) -> np.ndarray:
+        """Rows of documents visible for school"""
+        if school_id is None:
+            school_id = NO_SCHOOL
+        rows = self._school_rows.get(school_id)
+        if rows is None:
+            rows = np.flatnonzero(self.school_mask(school_id))
+            self._school_rows[school_id] = rows
+        return rows
+
+    def similarities(self, queries, school_id: int | None = None):
+        """Cosine similarity of every query against documents visible for school.
+        Returns rows of those documents and a (queries x rows) similarity matrix."""
+        queries = normalize_rows(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        rows = self.school_rows(school_id)
+        similarities = np.empty((len(queries), len(rows)), dtype=np.float32)
+        if len(self) == 0:
+            # Empty matrix has no width to match queries against
+            return rows, similarities
+        for start in range(0, len(queries), QUERY_CHUNK_SIZE):
+            chunk = queries[start : start + QUERY_CHUNK_SIZE]
+            scores = chunk @ self.embeddings.T
+            similarities[start : start + len(chunk)] = (
+                scores if len(rows) == len(self) else scores[:, rows]
+            )
+        return rows, similarities
@@ -5,7 +5,9 @@ import json
 import glob
 import multiprocessing
 import openai
-from db_engine.config import get_database
+from db_engine.config import get_database, ann_path, matrix_path
+from db_engine.matrix import EmbeddingMatrix
+from db_engine.ann import IVFIndex
 from settings import settings
 
 
@@ -92,6 +94,21 @@ def process_document(document_abspath):
     # delete_document(document_filename)
 
 
+def build_search_index(database):
+    """Save embedding matrix of all indexed documents for the search engine,
+    along with IVF index if approximate search is enabled"""
+    documents = database.get_documents()
+    if len(documents) == 0:
+        return
+    matrix = EmbeddingMatrix.from_documents(documents)
+    matrix.save(matrix_path)
+    if settings.search_ann:
+        print(f"Building IVF index for {len(documents)} documents")
+        IVFIndex.train(matrix.embeddings, settings.search_ann_lists).save(
+            ann_path, matrix.ids
+        )
+
+
 def main():
     """Main func"""
     with get_database() as database:
@@ -109,5 +126,7 @@ def main():
             pool.close()
             pool.join()
 
+        build_search_index(database)
+
 
 main()
@@ -1,5 +1,6 @@
 """service settings and dotenv"""
 import os
+from typing import Literal
 from dotenv import load_dotenv
 from pydantic import BaseSettings
 
@@ -18,8 +19,103 @@ class Settings(BaseSettings):
     # OpenAI text embedding model
     embedding_model: str = "text-embedding-ada-002"
 
+    # Seconds before OpenAI API calls time out
+    openai_timeout: float = 30
+    # Maximal number of concurrent calls per OpenAI endpoint in a worker
+    openai_max_concurrency: int = 16
+    # HTTP connections to OpenAI API kept open by a worker
+    openai_pool_size: int = 32
+    # Identical OpenAI calls made concurrently share a single upstream call
+    openai_single_flight: bool = True
+
+    # Requests handled at once by a worker, separately for messages,
+    # audio messages and search endpoints
+    admission_max_concurrency: int = 32
+    # Requests waiting for a slot, more are rejected with 429
+    admission_max_queue: int = 64
+    # Seconds a request waits for a slot before it's rejected with 503
+    admission_queue_timeout: float = 5
+    # Seconds clients are asked to wait before retrying rejected requests
+    admission_retry_after: int = 1
+
+    # Seconds a messages request should be answered in, unless it sets its own
+    messages_deadline: float = 5
+    # Seconds the completion is expected to take. Retrieval may use the budget
+    # left beyond it, max_tokens is cut proportionally when less is left
+    messages_completion_budget: float = 2.5
+    # Seconds that must be left after the completion to generate quick replies
+    messages_quick_replies_budget: float = 2.5
+
+    # How quick replies are generated: "separate" completion after the response,
+    # "inline", asking for them within the response in a single completion, or
+    # "deferred", generated in background and fetched by message id later
+    quick_replies_mode: Literal["separate", "inline", "deferred"] = "separate"
+    # Deferred quick replies kept, least recently used are evicted
+    quick_replies_cache_entries: int = 1024
+    # Seconds deferred quick replies are kept for
+    quick_replies_cache_ttl: float = 600
+
+    # Estimated tokens of prompt sent for completion: system prompt, school,
+    # document and latest messages. Older messages are folded into a rolling
+    # summary of the chat, or left out for chats that aren't stored
+    context_token_budget: int = 3000
+    # Latest messages sent in full regardless of budget
+    context_min_messages: int = 3
+
+    # Approximate nearest neighbour search using IVF index built by the indexer
+    search_ann: bool = False
+    # Number of IVF lists, defaults to square root of indexed documents count
+    search_ann_lists: int | None = None
+    # Number of closest IVF lists scanned per query
+    search_ann_probes: int = 8
+
+    # Search chat context with a single recency weighted mean of message
+    # embeddings instead of searching for every message separately
+    search_query_fusion: bool = False
+    # Weight of a message relative to the next one in the fused query
+    search_fusion_decay: float = 0.5
+
+    # Keep only search related document fields in memory and fetch
+    # the rest from index database for documents found
+    search_lazy_documents: bool = False
+
+    # Query embeddings kept in memory, least recently used are evicted
+    # once either limit is reached
+    embedding_cache_entries: int | None = 4096
+    embedding_cache_bytes: int | None = 32 * 1024 * 1024
+    # Seconds cached embeddings stay valid, forever if not set
+    embedding_cache_ttl: float | None = None
+    # SQLite database keeping cached embeddings across restarts, if set
+    embedding_cache_path: str | None = None
+    # Embeddings kept in SQLite, oldest are removed once it's exceeded
+    embedding_cache_disk_entries: int | None = 1_000_000
+    # Writes to SQLite between removals of expired and excess embeddings
+    embedding_cache_prune_interval: int = 1000
+
+    # Reuse answers to single-turn questions similar enough to ones answered before
+    answer_cache: bool = False
+    # Minimal cosine similarity of questions sharing an answer
+    answer_cache_threshold: float = 0.97
+    # Answers kept, least recently used are evicted
+    answer_cache_entries: int | None = 1024
+    # Seconds answers are reused for, forever if not set
+    answer_cache_ttl: float | None = 3600
+
+    # Seconds between checks whether the indexer rebuilt the index,
+    # the index is reloaded only on restart if not set
+    search_refresh_interval: float | None = None
+
     # API database
     db_path: str = "data/db/api_data.sqlite"
+    # Seconds a write waits for other writers before failing with "database is locked"
+    db_busy_timeout: float = 5
+    # NORMAL is durable in WAL mode except for the last commits on power loss
+    db_synchronous: Literal["OFF", "NORMAL", "FULL"] = "NORMAL"
+    # Bytes of database file read through memory mapping, 0 to disable
+    db_mmap_size: int = 256 * 1024 * 1024
+    # Threads running database reads, each with its own connection,
+    # writes run on one more thread
+    db_reader_threads: int = 4
 
     port: int = 8080
 